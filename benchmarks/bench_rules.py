@@ -0,0 +1,497 @@
+"""Benchmarks the rule engine offline, without reddit or PostgreSQL.
+
+Checks each queue with check_queue() against a fake reddit session that
+serves synthetic (or recorded) listings, using an in-memory SQLite database
+seeded with condition trees like real subreddits use. Each queue is checked
+twice, first with empty caches and then again with everything cached, and
+items per second, database queries per item and API calls per item are
+reported for both, along with how many items were checked, skipped and hit
+errors. If any item or listing raises an error, the benchmark exits with an
+error after reporting.
+
+    python benchmarks/bench_rules.py
+    python benchmarks/bench_rules.py --listings recorded.json
+
+Recorded listings are a JSON object mapping queue names (report, spam,
+submission, comment) to lists of things as returned by reddit's API, like
+{"kind": "t3", "data": {...}}. Items are checked against the seeded
+subreddits, so only items in subreddits named sr0, sr1, ... are checked.
+
+API calls are the requests that would have been sent through the request
+scheduler, the fake session answers all of them instantly. Meme pages are
+never loaded, the names of synthetic meme items are cached before checking.
+"""
+import os
+import sys
+import json
+import random
+import shutil
+import logging
+import tempfile
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from time import time
+
+# models.py reads modbot.cfg from the directory of the script being run, so
+# the config is written to a scratch directory that the script pretends to
+# be in before anything imports it
+SCRATCH_DIR = tempfile.mkdtemp(prefix='bench_rules_')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.argv[0] = os.path.join(SCRATCH_DIR, 'modbot.py')
+
+CONFIG = '''
+[database]
+system = sqlite
+host =
+database =
+username =
+password =
+
+[reddit]
+user_agent = bench_rules
+username = AutoModerator
+password =
+# never make the benchmark wait for the rate limit
+requests_per_minute = 60000000
+request_burst = 1000000
+'''
+
+with open(os.path.join(SCRATCH_DIR, 'modbot.cfg'), 'w') as cfg:
+    cfg.write(CONFIG)
+
+import reddit
+from sqlalchemy import event
+
+from models import app, db, Subreddit, Condition, Network
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+import modbot
+
+WORDS = ('cat dog funny pics help question today first time anyone else '
+         'my new game update leak spoiler free giveaway discount meme rage '
+         'comic finally built found made look this what why how').split()
+DOMAINS = ['i.imgur.com', 'imgur.com', 'youtube.com', 'self.sr', 'flickr.com',
+           'quickmeme.com', 'blogspot.com', 'tinyurl.com', 'bit.ly',
+           'livememe.com', 'nytimes.com', 'reddit.com']
+MEME_NAMES = ['Scumbag Steve', 'Good Guy Greg', 'Socially Awkward Penguin',
+              'Success Kid', 'Foul Bachelor Frog']
+
+
+class FakeThing(object):
+
+    """Mixin giving fake reddit objects their attributes directly.
+
+    Attributes are never fetched lazily, and every request method does
+    nothing, so checking an item never touches the network.
+
+    """
+
+    def __init__(self, session, **data):
+        self.__dict__.update(data)
+        self.__dict__['reddit_session'] = session
+
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+
+    def __getattr__(self, name):
+        raise AttributeError(name)
+
+    @property
+    def content_id(self):
+        return self.name
+
+    def remove(self, spam=True):
+        pass
+
+    def approve(self):
+        pass
+
+    def set_flair(self, text='', css_class=''):
+        pass
+
+    def distinguish(self):
+        pass
+
+    def reply(self, text):
+        return self.reddit_session.make_comment(self)
+
+    add_comment = reply
+
+
+class FakeSubmission(FakeThing, reddit.objects.Submission):
+    pass
+
+
+class FakeComment(FakeThing, reddit.objects.Comment):
+    pass
+
+
+class FakeRedditor(object):
+
+    """A user, with karma and age derived from their name."""
+
+    def __init__(self, name):
+        self.name = name
+        seed = sum(ord(c) for c in name)
+        self.is_gold = seed % 7 == 0
+        self.link_karma = seed * 13 % 5000
+        self.comment_karma = seed * 31 % 20000
+        self.created_utc = time() - 86400 * (seed % 1000)
+        self.shadowbanned = seed % 50 == 0
+
+    def get_overview(self, limit=None):
+        if self.shadowbanned:
+            raise Exception('404 Not Found')
+        return []
+
+
+class FakeSubreddit(object):
+
+    """A subreddit, or the /r/mod multi serving the fake listings."""
+
+    def __init__(self, session, display_name):
+        self.reddit_session = session
+        self.display_name = display_name
+
+    def get_reports(self, limit=None):
+        return iter(self.reddit_session.listings['report'])
+
+    def get_modqueue(self, limit=None):
+        return iter(self.reddit_session.listings['spam'])
+
+    def get_new_by_date(self, limit=None):
+        return iter(self.reddit_session.listings['submission'])
+
+    def get_comments(self, limit=None):
+        return iter(self.reddit_session.listings['comment'])
+
+    def get_moderators(self):
+        return [FakeRedditor('mod%s' % i) for i in xrange(5)]
+
+    def get_contributors(self):
+        return [FakeRedditor('user%s' % i) for i in xrange(0, 2000, 20)]
+
+
+class FakeReddit(object):
+
+    """Stands in for the reddit session, serving listings by queue name."""
+
+    def __init__(self):
+        self.listings = dict()
+        self.comments = 0
+
+    def get_subreddit(self, name):
+        return FakeSubreddit(self, name)
+
+    def get_redditor(self, user, fetch=True):
+        return FakeRedditor(getattr(user, 'name', user))
+
+    def get_info(self, thing_id=None):
+        raise Exception('%s is not in the fake listings' % thing_id)
+
+    def compose_message(self, recipient, subject, message):
+        pass
+
+    def make_comment(self, parent):
+        self.comments += 1
+        return FakeComment(self, name='t1_bench%x' % self.comments)
+
+
+def random_text(length):
+    return ' '.join(random.choice(WORDS) for i in xrange(length))
+
+
+def make_item(session, kind, n, options, created_utc):
+    """Returns a synthetic submission or comment."""
+    subreddit = 'sr%s' % (n % options.subreddits)
+    user = random.randint(0, 2000)
+    author = None if user == 0 else FakeRedditor('user%s' % user)
+    data = {'id': '%x' % n,
+            'subreddit': FakeSubreddit(session, subreddit),
+            'author': author,
+            'created_utc': created_utc,
+            'approved_by': None,
+            'num_reports': 0,
+            'author_flair_text': random.choice([None, 'regular', 'verified']),
+            'author_flair_css_class': None}
+    if kind == 'comment':
+        data.update(name='t1_%x' % n,
+                    link_id='t3_%x' % (n // 10),
+                    body=random_text(random.randint(3, 60)))
+        return FakeComment(session, **data)
+
+    domain = random.choice(DOMAINS).replace('self.sr', 'self.'+subreddit)
+    url = 'http://%s/%x' % (domain, n)
+    media = None
+    if domain == 'youtube.com':
+        media = {'oembed': {'author_name': 'channel%s' % (n % 300),
+                            'description': random_text(12)}}
+    if domain == 'quickmeme.com':
+        modbot.meme_cache.set(url, random.choice(MEME_NAMES))
+    data.update(name='t3_%x' % n,
+                title=random_text(random.randint(3, 15)),
+                url=url,
+                domain=domain,
+                selftext=random_text(40) if domain.startswith('self.') else '',
+                media=media,
+                permalink='http://www.reddit.com/r/%s/comments/%x/'
+                          % (subreddit, n))
+    return FakeSubmission(session, **data)
+
+
+def make_listings(session, options):
+    """Returns synthetic listings for each queue, newest items first."""
+    listings = dict()
+    now = time()
+    n = 0
+    for name in modbot.QUEUES:
+        items = list()
+        for i in xrange(options.items):
+            n += 1
+            if name == 'comment' or (name != 'submission' and n % 3 == 0):
+                kind = 'comment'
+            else:
+                kind = 'submission'
+            item = make_item(session, kind, n, options, now - 60 - i * 5)
+            if name == 'report':
+                item.num_reports = random.choice([1, 1, 1, 2, 3, 5])
+                if random.random() < 0.2:
+                    item.approved_by = FakeRedditor('mod0')
+            items.append(item)
+        listings[name] = items
+    return listings
+
+
+def load_listings(session, path):
+    """Returns recorded listings from a file, see the module docstring."""
+    with open(path) as listings_file:
+        recorded = json.load(listings_file)
+
+    listings = dict((name, []) for name in modbot.QUEUES)
+    for name, things in recorded.iteritems():
+        for thing in things:
+            data = dict(thing['data'])
+            data['subreddit'] = FakeSubreddit(session, data['subreddit'])
+            for key in ('author', 'approved_by'):
+                if data.get(key) and data[key] != '[deleted]':
+                    data[key] = FakeRedditor(data[key])
+                else:
+                    data[key] = None
+            data.setdefault('num_reports', 0)
+            if thing['kind'] == 't3':
+                listings[name].append(FakeSubmission(session, **data))
+            else:
+                listings[name].append(FakeComment(session, **data))
+    return listings
+
+
+def make_condition(**values):
+    values.setdefault('subject', 'both')
+    values.setdefault('action', 'remove')
+    values.setdefault('inverse', False)
+    values.setdefault('auto_reapproving', False)
+    sub_conditions = values.pop('sub_conditions', [])
+    condition = Condition(**values)
+    for sub_values in sub_conditions:
+        sub_values.setdefault('subject', values['subject'])
+        condition.additional_conditions.append(make_condition(**sub_values))
+    return condition
+
+
+def seed_conditions(subreddit_id=None, network_id=None):
+    """Returns a set of top-level conditions like a busy subreddit has."""
+    owner = {'subreddit_id': subreddit_id, 'network_id': network_id}
+    banned_users = '|'.join('user%s' % random.randint(1, 2000)
+                            for i in xrange(40))
+    conditions = [
+        # banned domains and users, as literal alternations
+        dict(attribute='domain', value='(tinyurl\\.com|bit\\.ly)', spam=True,
+             subject='submission', comment='Link shorteners are not allowed.',
+             comment_method='comment'),
+        dict(attribute='user', value='('+banned_users+')', spam=True),
+        # keyword filters
+        dict(attribute='title', value='.*(giveaway|free|discount).*',
+             subject='submission', comment='Please read the rules on '
+             'giveaways.', comment_method='message'),
+        dict(attribute='body', value='.*(leak|spoiler).*', action='alert'),
+        dict(attribute='media_user', value='channel(1|2|3)\\d', spam=True,
+             subject='submission'),
+        # new or low-karma accounts posting links
+        dict(attribute='domain', value='self\\..*', inverse=True,
+             subject='submission', account_age=7, combined_karma=100,
+             sub_conditions=[dict(attribute='title', value='.*\\bmy\\b.*')]),
+        # shadowbanned users and memes
+        dict(attribute='user', value='.*', is_shadowbanned=True,
+             subject='comment', action='alert'),
+        dict(attribute='meme_name', value='(Scumbag Steve|Success Kid)',
+             subject='submission'),
+        # approvals and flair
+        dict(attribute='user', value='.*', action='approve',
+             account_rank='contributor'),
+        dict(attribute='domain', value='(i\\.)?imgur\\.com',
+             action='set_flair', subject='submission',
+             set_flair_text='image', set_flair_class='image'),
+        dict(attribute='author_flair_text', value='verified', action='approve',
+             is_gold=True),
+        # reports
+        dict(attribute='user', value='.*', num_reports=3, action='alert',
+             comment='Item reported 3 or more times.',
+             comment_method='modmail'),
+        dict(attribute='title', value='.*(rage|comic).*', num_reports=2,
+             auto_reapproving=None, subject='submission'),
+        dict(attribute='body', value='.*', num_reports=5, spam=False,
+             subject='comment', sub_conditions=[
+                 dict(attribute='user', value='.*', link_karma=1000,
+                      inverse=True)]),
+    ]
+    for values in conditions:
+        values.update(owner)
+        for sub_values in values.get('sub_conditions', []):
+            sub_values.update(owner)
+    return [make_condition(**values) for values in conditions]
+
+
+def seed_database(options):
+    """Creates the tables and returns the seeded subreddits by name."""
+    db.create_all()
+
+    network = Network(short_name='benchnet', enabled=True)
+    db.session.add(network)
+    db.session.flush()
+    for condition in seed_conditions(network_id=network.id):
+        db.session.add(condition)
+
+    long_ago = datetime.utcnow() - timedelta(days=30)
+    for i in xrange(options.subreddits):
+        subreddit = Subreddit(name='sr%s' % i,
+                              network=network.id if i % 2 else None,
+                              last_submission=long_ago,
+                              last_spam=long_ago,
+                              last_comment=long_ago,
+                              auto_reapprove=i % 4 == 0,
+                              check_all_conditions=i % 5 == 0)
+        db.session.add(subreddit)
+        db.session.flush()
+        for condition in seed_conditions(subreddit_id=subreddit.id):
+            db.session.add(condition)
+    db.session.commit()
+    return modbot.load_subreddits()
+
+
+def reset_watermarks(sr_dict):
+    """Moves watermarks back so the same listings are checked again."""
+    long_ago = datetime.utcnow() - timedelta(days=30)
+    for subreddit in sr_dict.itervalues():
+        for column in modbot.WATERMARKS.itervalues():
+            setattr(subreddit, column, long_ago)
+    db.session.commit()
+
+
+def check_queues(session, sr_dict, condition_dict):
+    """Checks every queue once, returning results by queue name.
+
+    Rates are per item actually checked, as counted by check_items(), not
+    per item in the listing, since items can be skipped (items in other
+    subreddits, or behind a watermark) or left unchecked by an error.
+    """
+    mod_subreddit = session.get_subreddit('mod')
+    counters = modbot.metrics.counters
+    results = dict()
+    for name in modbot.QUEUES:
+        before = dict((counter, counters.get('queue.%s.%s' % (name, counter),
+                                             0))
+                      for counter in ('items', 'skipped', 'errors'))
+        queries = check_queues.queries
+        requests = modbot.scheduler.requests
+        start_time = time()
+        modbot.check_queue(name, mod_subreddit, sr_dict, condition_dict)
+        elapsed = time() - start_time
+        counts = dict((counter, counters.get('queue.%s.%s' % (name, counter),
+                                             0) - value)
+                      for counter, value in before.iteritems())
+        checked = counts['items']
+        results[name] = {'listed': len(session.listings[name]),
+                         'checked': checked,
+                         'skipped': counts['skipped'],
+                         'errors': counts['errors'],
+                         'rate': checked / max(elapsed, 0.000001),
+                         'queries': float(check_queues.queries - queries) /
+                                        max(checked, 1),
+                         'requests': float(modbot.scheduler.requests -
+                                           requests) / max(checked, 1)}
+    return results
+check_queues.queries = 0
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--items', type='int', default=1000,
+                      help='synthetic items in each queue')
+    parser.add_option('-s', '--subreddits', type='int', default=50,
+                      help='number of subreddits to seed conditions for')
+    parser.add_option('-l', '--listings',
+                      help='JSON file of recorded listings to check instead')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed for generating the synthetic data')
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help='show the bot\'s own log messages')
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if not options.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    random.seed(options.seed)
+
+    try:
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count_query(*args):
+            check_queues.queries += 1
+
+        sr_dict = seed_database(options)
+        condition_dict = modbot.load_conditions(sr_dict)
+
+        session = FakeReddit()
+        modbot.r = session
+        if options.listings:
+            session.listings = load_listings(session, options.listings)
+        else:
+            session.listings = make_listings(session, options)
+
+        cold = check_queues(session, sr_dict, condition_dict)
+        # the second pass is a new run, so items are checked again
+        reset_watermarks(sr_dict)
+        modbot.new_pass()
+        warm = check_queues(session, sr_dict, condition_dict)
+
+        logging.getLogger().setLevel(logging.INFO)
+        logging.info('%-12s %7s %7s %7s %7s %10s %10s %10s %10s %10s %10s',
+                     '', '', '', '', '', 'cold', '', '', 'warm', '', '')
+        logging.info('%-12s %7s %7s %7s %7s %10s %10s %10s %10s %10s %10s',
+                     'queue', 'listed', 'checked', 'skipped', 'errors',
+                     'items/s', 'queries', 'API calls', 'items/s', 'queries',
+                     'API calls')
+        errors = 0
+        for name in modbot.QUEUES:
+            errors += cold[name]['errors'] + warm[name]['errors']
+            logging.info('%-12s %7d %7d %7d %7d %10.0f %10.2f %10.2f %10.0f '
+                         '%10.2f %10.2f', name, cold[name]['listed'],
+                         cold[name]['checked'], cold[name]['skipped'],
+                         cold[name]['errors'], cold[name]['rate'],
+                         cold[name]['queries'], cold[name]['requests'],
+                         warm[name]['rate'], warm[name]['queries'],
+                         warm[name]['requests'])
+        logging.info('(items/s, queries and API calls are per item checked, '
+                     'counts are for the cold pass)')
+        for name in modbot.QUEUES:
+            if warm[name]['checked'] != cold[name]['checked']:
+                logging.warning('The warm pass checked %s %s items, the cold '
+                                'pass %s', warm[name]['checked'], name,
+                                cold[name]['checked'])
+        if errors:
+            raise SystemExit('%s items or listings raised errors, the results '
+                             'are incomplete' % errors)
+    finally:
+        shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+-- Adds the indexes the bot's hot-path queries rely on, and makes
+-- auto_reapprovals.permalink unique.
+--
+-- Run against an existing PostgreSQL database with:
+--     psql -d database_name -f migrations/001_action_log_indexes.sql
+--
+-- CREATE INDEX CONCURRENTLY can't run inside a transaction, so this file
+-- doesn't use one. Each index is built without locking out the bot, which
+-- can keep running while this migration does. If a build fails, drop the
+-- INVALID index it leaves behind and run the file again.
+
+-- merge duplicate auto-reapproval entries into the oldest one per permalink
+-- so the unique index below can be built
+BEGIN;
+UPDATE auto_reapprovals AS keep
+   SET total_reports = merged.total_reports,
+       first_approval_time = merged.first_approval_time,
+       last_approval_time = merged.last_approval_time
+  FROM (SELECT permalink,
+               min(id) AS id,
+               sum(total_reports) AS total_reports,
+               min(first_approval_time) AS first_approval_time,
+               max(last_approval_time) AS last_approval_time
+          FROM auto_reapprovals
+         WHERE permalink IS NOT NULL
+         GROUP BY permalink
+        HAVING count(*) > 1) AS merged
+ WHERE keep.id = merged.id;
+
+DELETE FROM auto_reapprovals AS dup
+ USING auto_reapprovals AS keep
+ WHERE dup.permalink = keep.permalink
+   AND dup.id > keep.id;
+COMMIT;
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS auto_reapprovals_permalink_key
+    ON auto_reapprovals (permalink);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_auto_reapprovals_subreddit_id
+    ON auto_reapprovals (subreddit_id);
+
+-- alert deduplication and journal replays
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_action_log_permalink_action
+    ON action_log (permalink, action);
+-- recent approvals for modmail replies
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_action_log_action_action_time
+    ON action_log (action, action_time);
+-- loading recent alerts
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_action_log_action_created_utc
+    ON action_log (action, created_utc);
+-- per-subreddit history
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_action_log_subreddit_action_time
+    ON action_log (subreddit_id, action_time);
+-- pruning old entries
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_action_log_action_time
+    ON action_log (action_time);
+
+ANALYZE action_log;
+ANALYZE auto_reapprovals;
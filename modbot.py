@@ -1,17 +1,33 @@
+import os
 import re
+import sys
+import signal
 import logging, logging.config
+import threading
 import urllib2
+from urlparse import urlparse
+from multiprocessing.pool import ThreadPool
 from datetime import datetime, timedelta
-from time import time
+from time import time, sleep
 
 import reddit
 from BeautifulSoup import BeautifulSoup
-from sqlalchemy import func
-from sqlalchemy.sql import and_
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.orm import noload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import and_, or_
 
 from models import cfg_file, path_to_cfg, db, Subreddit, Condition, \
     ActionLog, AutoReapproval, Network
+from modbot_buffer import WriteBuffer
+from modbot_cache import LRUCache, TTLCache
+from modbot_matcher import ConditionMatcher, get_condition_regex
+from modbot_metrics import Metrics
+from modbot_outbox import Outbox
+from modbot_stats import ConditionStats
+from modbot_stream import CommentStream, MAX_MULTI_LENGTH
+from modbot_workers import ShardLocks, get_shard
+from modbot_scheduler import RequestScheduler, PRIORITY_ACTION, \
+    PRIORITY_NOTIFY, PRIORITY_LOOKUP
 
 # global reddit session
 r = None
@@ -20,13 +36,139 @@ r = None
 REPORT_BACKLOG_LIMIT = timedelta(days=2)
 
 
+
+def cfg_get(section, option, default=None):
+    """Returns an option from the config file, or default if it isn't set."""
+    if cfg_file.has_option(section, option):
+        return cfg_file.get(section, option)
+    return default
+
+
+def cfg_path(section, option, default):
+    """Returns a file path from the config, relative to the config file.
+
+    When running as a worker, file names are prefixed with the worker's name
+    so several workers can run from the same directory.
+    """
+    path = os.path.join(os.path.dirname(path_to_cfg),
+                        cfg_get(section, option, default))
+    return os.path.join(os.path.dirname(path),
+                        cfg_path.prefix+os.path.basename(path))
+cfg_path.prefix = ''
+
+
+# cached gold/karma/age info for redditors, and results of shadowban checks
+user_cache = TTLCache(int(cfg_get('cache', 'user_cache_size', 20000)),
+                      int(cfg_get('cache', 'user_ttl', 3600)))
+shadowban_cache = TTLCache(int(cfg_get('cache', 'user_cache_size', 20000)),
+                           int(cfg_get('cache', 'shadowban_ttl', 21600)))
+
+# meme names by page url, and hosts that recently failed to load
+meme_cache = TTLCache(int(cfg_get('cache', 'meme_cache_size', 20000)),
+                      int(cfg_get('cache', 'meme_ttl', 604800)))
+meme_host_failures = TTLCache(1000,
+                              int(cfg_get('cache', 'meme_failure_ttl', 300)))
+
+# seconds to wait on a meme site before giving up
+MEME_FETCH_TIMEOUT = int(cfg_get('cache', 'meme_fetch_timeout', 10))
+
+# ItemViews of items checked since conditions were loaded, by fullname
+item_views = LRUCache(int(cfg_get('cache', 'item_view_size', 5000)))
+
+# moderator/contributor name sets, keyed by (subreddit name, rank)
+rank_cache = TTLCache(int(cfg_get('cache', 'rank_cache_size', 2000)),
+                      int(cfg_get('cache', 'rank_ttl', 3600)))
+
+# alerts on items created within this long are deduplicated in memory
+ALERT_DEDUP_WINDOW = timedelta(
+    days=int(cfg_get('cache', 'alert_window_days', 7)))
+
+# spaces out all reddit API requests, 30 per minute by default
+scheduler = RequestScheduler(
+    float(cfg_get('reddit', 'requests_per_minute', 30)) / 60,
+    int(cfg_get('reddit', 'request_burst', 5)))
+
+# measured cost and hit rate of each condition, with every request counted
+# as costing the time it uses up of the rate limit
+condition_stats = ConditionStats(1 / scheduler.rate)
+
+# attributes that need a request to extract, only checked once everything
+# else about a condition has passed
+EXPENSIVE_ATTRIBUTES = ('meme_name',)
+
+# timings and counters for the whole run, saved to metrics_file
+metrics = Metrics()
+
+# maximum number of values to put in a single IN (...) query
+PREFETCH_CHUNK_SIZE = 500
+
+# ActionLog and AutoReapproval rows waiting to be committed
+write_buffer = WriteBuffer(cfg_path('database', 'journal_file',
+                                    'action_journal.log'),
+                           int(cfg_get('database', 'batch_size', 100)))
+
+# comments and messages waiting to be delivered
+outbox = Outbox(cfg_path('reddit', 'outbox_file', 'outbox.db'),
+                int(cfg_get('reddit', 'outbox_workers', 4)),
+                int(cfg_get('reddit', 'outbox_max_attempts', 5)),
+                int(cfg_get('reddit', 'outbox_retry_delay', 60)))
+
+# queues checked by do_subreddits, in the order they're checked
+QUEUES = ('report', 'spam', 'submission', 'comment')
+
+# subreddit columns holding the newest item checked in each queue
+WATERMARKS = {'spam': 'last_spam',
+              'submission': 'last_submission',
+              'comment': 'last_comment'}
+
+# if True, the listings for all queues are fetched at the same time
+PREFETCH_QUEUES = cfg_get('reddit', 'prefetch_queues', 'false') == 'true'
+
+# if True, comments are polled in shards sized by each subreddit's traffic
+# instead of all at once, see CommentStream
+COMMENT_STREAM = cfg_get('reddit', 'comment_stream', 'false') == 'true'
+comment_stream = CommentStream(
+    int(cfg_get('reddit', 'comment_poll_items', 500)),
+    int(cfg_get('reddit', 'comment_min_interval', 15)),
+    int(cfg_get('reddit', 'comment_max_interval', 300)))
+
+# number of shards subreddits are split into for workers, and seconds a
+# shard must be without its worker before another worker takes it over
+WORKER_SHARDS = int(cfg_get('workers', 'shards', 4))
+WORKER_TAKEOVER_DELAY = int(cfg_get('workers', 'takeover_delay', 300))
+
+# tasks for all subreddits, only run by the worker holding shard 0
+GLOBAL_TASKS = ('modmail', 'network')
+
+# tasks run by the daemon each cycle, in order
+DAEMON_TASKS = QUEUES + ('outbox', 'modmail', 'network')
+
+# default seconds between daemon runs of each task, overridden by the
+# <name>_interval options in the [daemon] section of the config
+DAEMON_INTERVALS = {'report': 60,
+                    'spam': 30,
+                    'submission': 30,
+                    'comment': 30,
+                    'outbox': 15,
+                    'modmail': 60,
+                    'network': 3600,
+                    'reload': 60,
+                    'cache': 300}
+
+# shared empty bucket for queues/actions a subreddit has no conditions for
+NO_CONDITIONS = ConditionMatcher([])
+
+
 def perform_action(subreddit, item, condition):
     """Performs the action for the condition(s).
     
-    Also delivers the comment (if set) and creates an ActionLog entry.
+    Also queues the comment (if set) and creates an ActionLog entry. The
+    entry is journaled before the action is performed, and discarded again
+    if performing it fails.
     """
     
     global r
+    start_time = time()
     disclaimer = ('\n\n*I am a bot, and this action was performed '
                     'automatically. Please [contact the moderators of this '
                     'subreddit](http://www.reddit.com/message/compose?'
@@ -35,6 +177,7 @@ def perform_action(subreddit, item, condition):
 
     # build the comment if multiple conditions were matched
     if isinstance(condition, list):
+        comment = None
         if any([c.comment for c in condition]):
             if condition[0].action == 'alert':
                 verb = 'alerted'
@@ -55,40 +198,18 @@ def perform_action(subreddit, item, condition):
 
     # abort if it's an alert and we've already alerted on this item
     if condition.action == 'alert':
-        try:
-            ActionLog.query.filter(
-                and_(ActionLog.permalink == get_permalink(item),
-                     ActionLog.action == 'alert')).one()
+        if already_alerted(item):
             return
-        except NoResultFound:
-            pass
-
-    # perform the action
-    if condition.action == 'remove':
-        item.remove(condition.spam)
-    elif condition.action == 'approve':
-        item.approve()
-    elif condition.action == 'set_flair':
-        item.set_flair(condition.set_flair_text,
-                       condition.set_flair_class)
 
-    # deliver the comment if set
-    if comment:
-        if condition.comment_method == 'comment':
-            post_comment(item, comment+disclaimer)
-        elif condition.comment_method == 'modmail':
-            r.compose_message('#'+subreddit.name,
-                              'AutoModerator condition matched',
-                              get_permalink(item)+'\n\n'+comment)
-        elif condition.comment_method == 'message':
-            r.compose_message(item.author.name,
-                              'AutoModerator condition matched',
-                              get_permalink(item)+'\n\n'+comment+disclaimer)
-
-    # log the action taken
+    # log the action before it's performed, so an action that's been
+    # performed on reddit is always journaled
+    if item.author is not None:
+        user = item.author.name
+    else:
+        user = '[deleted]'
     action_log = ActionLog()
     action_log.subreddit_id = subreddit.id
-    action_log.user = item.author.name
+    action_log.user = user
     action_log.permalink = get_permalink(item)
     action_log.created_utc = datetime.utcfromtimestamp(item.created_utc)
     action_log.action_time = datetime.utcnow()
@@ -107,33 +228,217 @@ def perform_action(subreddit, item, condition):
         logging.info('  /r/%s: %s comment by user %s',
                         subreddit.name,
                         condition.action,
-                        item.author.name)
+                        user)
 
-    db.session.add(action_log)
-    db.session.commit()
+    write_buffer.add(action_log)
+
+    # perform the action, and take the log entry back if it failed
+    try:
+        if condition.action == 'remove':
+            scheduler.call(PRIORITY_ACTION, item.remove, condition.spam)
+        elif condition.action == 'approve':
+            scheduler.call(PRIORITY_ACTION, item.approve)
+        elif condition.action == 'set_flair':
+            scheduler.call(PRIORITY_ACTION, item.set_flair,
+                           condition.set_flair_text,
+                           condition.set_flair_class)
+    except Exception:
+        write_buffer.discard(action_log)
+        raise
+
+    if condition.action == 'alert':
+        already_alerted.permalinks.add(action_log.permalink)
+
+    # queue the comment for delivery if set
+    if comment:
+        if condition.comment_method == 'comment':
+            post_comment(item, comment+disclaimer)
+        elif condition.comment_method == 'modmail':
+            outbox.put('message', '#'+subreddit.name,
+                       get_permalink(item)+'\n\n'+comment,
+                       'AutoModerator condition matched')
+        elif (condition.comment_method == 'message' and
+                item.author is not None):
+            outbox.put('message', item.author.name,
+                       get_permalink(item)+'\n\n'+comment+disclaimer,
+                       'AutoModerator condition matched')
+
+    metrics.add_time('action.'+condition.action, time() - start_time)
+
+
+def already_alerted(item):
+    """Returns True if an alert has already been logged for the item.
+
+    Alerts on items created within ALERT_DEDUP_WINDOW are loaded into a set
+    once, and kept up to date as alerts are logged, so checking most items
+    doesn't need a query. Items older than that are looked up in ActionLog.
+    """
+    now = datetime.utcnow()
+    if (already_alerted.cutoff is None or
+            now - already_alerted.cutoff > 2 * ALERT_DEDUP_WINDOW):
+        # reload periodically so the set doesn't grow forever in the daemon
+        already_alerted.cutoff = now - ALERT_DEDUP_WINDOW
+        already_alerted.permalinks = set([row.permalink for row in
+            db.session.query(ActionLog.permalink).filter(
+                and_(ActionLog.action == 'alert',
+                     ActionLog.created_utc >= already_alerted.cutoff))])
+
+    permalink = get_permalink(item)
+    if datetime.utcfromtimestamp(item.created_utc) >= already_alerted.cutoff:
+        return permalink in already_alerted.permalinks
+
+    return ActionLog.query.filter(
+        and_(ActionLog.permalink == permalink,
+             ActionLog.action == 'alert')).first() is not None
+already_alerted.cutoff = None
+already_alerted.permalinks = set()
 
 
 def post_comment(item, comment):
-    """Posts a distinguished comment as a reply to an item."""
-    if isinstance(item, reddit.objects.Submission):
-        response = item.add_comment(comment)
-        response.distinguish()
-    elif isinstance(item, reddit.objects.Comment):
-        response = item.reply(comment)
-        response.distinguish()
+    """Queues a distinguished comment as a reply to an item."""
+    outbox.put('comment', item.content_id, comment, thing=item)
+
 
+def deliver(kind, target, subject, body, thing):
+    """Delivers an entry from the outbox.
 
-def check_items(name, items, sr_dict, stop_time):
-    """Checks the items generator for any matching conditions."""
+    Comments are distinguished as a separate delivery, so a failure to
+    distinguish one doesn't cause it to be posted again.
+    """
+    if kind == 'message':
+        scheduler.call(PRIORITY_NOTIFY, r.compose_message,
+                       target, subject, body)
+        return
+
+    if thing is None:
+        thing = scheduler.call(PRIORITY_NOTIFY, r.get_info, thing_id=target)
+    if kind == 'comment':
+        if isinstance(thing, reddit.objects.Submission):
+            response = scheduler.call(PRIORITY_NOTIFY, thing.add_comment, body)
+        else:
+            response = scheduler.call(PRIORITY_NOTIFY, thing.reply, body)
+        return [('distinguish', response.content_id, None, None, response)]
+    elif kind == 'distinguish':
+        scheduler.call(PRIORITY_NOTIFY, thing.distinguish)
+
+
+def deliver_outbox():
+    """Sends all comments and messages that are due for delivery."""
+    start_time = time()
+    delivered = outbox.delivered
+    outbox.drain(deliver)
+    metrics.add_time('outbox.drain', time() - start_time)
+    if outbox.delivered > delivered:
+        logging.info('  Delivered %s comments/messages in %s',
+                     outbox.delivered - delivered, elapsed_since(start_time))
+
+
+def check_item(name, item, subreddit, condition_dict):
+    """Checks a single item from queue name against subreddit's conditions."""
+    conditions = order_conditions(subreddit, condition_dict)
+    subject = get_subject(item)
+    view = get_item_view(item)
+
+    # skip items removed while checking an earlier queue
+    if view.removed:
+        return
+
+    # check removal conditions, stop checking if any matched
+    if check_conditions(subreddit, item,
+            conditions.get((name, subject, 'remove'), NO_CONDITIONS),
+            view):
+        view.removed = True
+        return
+
+    # check set_flair conditions 
+    check_conditions(subreddit, item,
+            conditions.get((name, subject, 'set_flair'), NO_CONDITIONS),
+            view)
+
+    # check approval conditions
+    check_conditions(subreddit, item,
+            conditions.get((name, subject, 'approve'), NO_CONDITIONS),
+            view)
+
+    # check alert conditions
+    check_conditions(subreddit, item,
+            conditions.get((name, subject, 'alert'), NO_CONDITIONS),
+            view)
+
+    # if doing reports, check auto-reapproval if enabled
+    if (name == 'report' and subreddit.auto_reapprove and
+            item.approved_by is not None):
+        # see if this item has already been auto-reapproved
+        entry = get_auto_reapproval(item)
+        in_db = entry is not None
+        if not in_db:
+            entry = AutoReapproval()
+            entry.subreddit_id = subreddit.id
+            entry.permalink = get_permalink(item)
+            entry.original_approver = item.approved_by.name
+            entry.total_reports = 0
+            entry.first_approval_time = datetime.utcnow()
+
+        if (in_db or item.approved_by.name !=
+                cfg_file.get('reddit', 'username')):
+            action_start = time()
+            # log the re-approval before it's performed, like other actions
+            old_values = (entry.total_reports, entry.last_approval_time)
+            entry.total_reports += item.num_reports
+            entry.last_approval_time = datetime.utcnow()
+            write_buffer.add(entry)
+            get_auto_reapproval.entries[entry.permalink] = entry
+
+            try:
+                scheduler.call(PRIORITY_ACTION, item.approve)
+            except Exception:
+                if in_db:
+                    entry.total_reports, entry.last_approval_time = old_values
+                    write_buffer.add(entry)
+                else:
+                    write_buffer.discard(entry)
+                    get_auto_reapproval.entries[entry.permalink] = None
+                raise
+
+            logging.info('  Re-approved %s', entry.permalink)
+            metrics.add_time('action.reapprove',
+                             time() - action_start)
+
+
+def check_items(name, items, sr_dict, condition_dict, stop_time):
+    """Checks the items generator for any matching conditions.
+
+    Watermarks are only moved up if the whole listing could be fetched, an
+    error checking a single item is logged and the item is skipped. Returns
+    True if the whole listing was checked.
+    """
     item_count = 0
     skip_count = 0
     skip_subs = set()
     start_time = time()
-    seen_subs = set()
+    newest_time = None
+    watermark = WATERMARKS.get(name)
+    # the watermarks as they were before this listing, they're only moved
+    # up once the whole listing has been checked
+    if watermark:
+        watermarks = dict((key, getattr(subreddit, watermark))
+                          for key, subreddit in sr_dict.iteritems())
+    # time spent fetching and performing actions isn't spent evaluating
+    fetch_seconds = metrics.seconds('queue.%s.fetch' % name)
+    action_seconds = metrics.seconds('action.')
 
     logging.info('Checking new %ss', name)
 
     try:
+        # load the auto-reapproval entries for all reports in one query
+        if name == 'report':
+            if not isinstance(items, list):
+                items = fetch_items(metrics.timed('queue.%s.fetch' % name,
+                                                  items), stop_time)
+            prefetch_auto_reapprovals(items)
+        else:
+            items = metrics.timed('queue.%s.fetch' % name, items)
+
         for item in items:
             # skip any items in /new that have been approved
             if name == 'submission' and item.approved_by:
@@ -142,78 +447,186 @@ def check_items(name, items, sr_dict, stop_time):
             item_time = datetime.utcfromtimestamp(item.created_utc)
             if item_time <= stop_time:
                 break
+            if newest_time is None:
+                newest_time = item_time
 
+            sr_name = item.subreddit.display_name.lower()
             try:
-                subreddit = sr_dict[item.subreddit.display_name.lower()]
+                subreddit = sr_dict[sr_name]
             except KeyError:
                 skip_count += 1
-                skip_subs.add(item.subreddit.display_name.lower())
+                skip_subs.add(sr_name)
                 continue
 
-            conditions = (subreddit.conditions
-                            .filter(Condition.parent_id == None)
-                            .all())
-            conditions = filter_conditions(name, conditions)
+            # skip items this subreddit has already had checked
+            if watermark and item_time <= watermarks[sr_name]:
+                continue
 
             item_count += 1
 
-            if subreddit.name not in seen_subs:
-                setattr(subreddit, 'last_'+name, item_time)
-                seen_subs.add(subreddit.name)
-
-            # check removal conditions, stop checking if any matched
-            if check_conditions(subreddit, item,
-                    [c for c in conditions if c.action == 'remove']):
-                continue
-
-            # check set_flair conditions 
-            check_conditions(subreddit, item,
-                    [c for c in conditions if c.action == 'set_flair'])
-
-            # check approval conditions
-            check_conditions(subreddit, item,
-                    [c for c in conditions if c.action == 'approve'])
-
-            # check alert conditions
-            check_conditions(subreddit, item,
-                    [c for c in conditions if c.action == 'alert'])
-
-            # if doing reports, check auto-reapproval if enabled
-            if (name == 'report' and subreddit.auto_reapprove and
-                    item.approved_by is not None):
-                try:
-                    # see if this item has already been auto-reapproved
-                    entry = (AutoReapproval.query.filter(
-                            AutoReapproval.permalink == get_permalink(item))
-                            .one())
-                    in_db = True
-                except NoResultFound:
-                    entry = AutoReapproval()
-                    entry.subreddit_id = subreddit.id
-                    entry.permalink = get_permalink(item)
-                    entry.original_approver = item.approved_by.name
-                    entry.total_reports = 0
-                    entry.first_approval_time = datetime.utcnow()
-                    in_db = False
-
-                if (in_db or item.approved_by.name !=
-                        cfg_file.get('reddit', 'username')):
-                    item.approve()
-                    entry.total_reports += item.num_reports
-                    entry.last_approval_time = datetime.utcnow()
-
-                    db.session.add(entry)
-                    db.session.commit()
-                    logging.info('  Re-approved %s', entry.permalink)
-                            
-        db.session.commit()
+            # an item that can't be checked (e.g. one whose author has been
+            # deleted) mustn't stop the rest of the listing being checked
+            try:
+                check_item(name, item, subreddit, condition_dict)
+            except Exception as e:
+                logging.error('  ERROR: Unable to check %s: %s',
+                              item.content_id, e)
+                metrics.increment('queue.%s.errors' % name)
+
+        # every item in the listing up to newest_time has now been checked,
+        # so every subreddit's watermark can move up to it
+        if watermark and newest_time:
+            for subreddit in queue_subreddits(name, sr_dict):
+                if getattr(subreddit, watermark) < newest_time:
+                    setattr(subreddit, watermark, newest_time)
+
+        write_buffer.flush()
+        checked = True
     except Exception as e:
         logging.error('  ERROR: %s', e)
-        db.session.rollback()
+        metrics.increment('queue.%s.errors' % name)
+        write_buffer.recover()
+        checked = False
+
+    fetch_seconds = metrics.seconds('queue.%s.fetch' % name) - fetch_seconds
+    action_seconds = metrics.seconds('action.') - action_seconds
+    metrics.add_time('queue.%s.evaluate' % name,
+                     time() - start_time - fetch_seconds - action_seconds,
+                     item_count)
+    metrics.increment('queue.%s.items' % name, item_count)
+    metrics.increment('queue.%s.skipped' % name, skip_count)
 
     logging.info('  Checked %s items, skipped %s items in %s (skips: %s)',
             item_count, skip_count, elapsed_since(start_time),
             ', '.join(skip_subs))
+    return checked
+
+
+def load_conditions(sr_dict):
+    """Loads the top-level conditions for all subreddits in sr_dict at once.
+
+    The conditions and all sub-conditions are loaded in a single query. A
+    subreddit's conditions include those of its network, if the network is
+    enabled, so each item only needs to be checked once.
+
+    Returns a dict keyed by subreddit id. Each value is a dict mapping
+    (queue name, subject, action) to a ConditionMatcher for the conditions
+    that apply, which order_conditions() sorts before they're checked.
+    """
+    condition_dict = dict()
+    sr_ids = [s.id for s in sr_dict.itervalues()]
+    if not sr_ids:
+        return condition_dict
+
+    network_ids = set([s.network for s in sr_dict.itervalues() if s.network])
+    if network_ids:
+        network_ids = [n.id for n in Network.query.filter(
+                            and_(Network.id.in_(list(network_ids)),
+                                 Network.enabled == True))]
+
+    owner = Condition.subreddit_id.in_(sr_ids)
+    if network_ids:
+        owner = or_(owner, and_(Condition.subreddit_id == None,
+                                Condition.network_id.in_(network_ids)))
+    # load the sub-conditions in the same query, and build the trees from
+    # parent_id, rather than have the relationship load each level of them
+    rows = (Condition.query
+            .options(noload('additional_conditions'))
+            .filter(or_(and_(owner, Condition.parent_id == None),
+                        Condition.parent_id != None))
+            .order_by(Condition.id)
+            .all())
+    conditions = list()
+    children = dict()
+    for condition in rows:
+        if condition.parent_id is None:
+            conditions.append(condition)
+        else:
+            children.setdefault(condition.parent_id, []).append(condition)
+    for condition in rows:
+        set_committed_value(condition, 'additional_conditions',
+                            children.get(condition.id, []))
+
+    # compile condition regexes so invalid ones are only reported once
+    invalid = compile_conditions(conditions)
+    if invalid:
+        logging.warning('  Found %s conditions with invalid regexes', invalid)
+
+    # detach the conditions from the session, otherwise every commit would
+    # expire them and they'd be reloaded one at a time on next use
+    detach_conditions(conditions)
+
+    by_network = dict()
+    for subreddit in sr_dict.itervalues():
+        if subreddit.network:
+            by_network.setdefault(subreddit.network, []).append(subreddit.id)
+
+    by_subreddit = dict()
+    for condition in conditions:
+        if condition.subreddit_id is not None:
+            sr_ids = [condition.subreddit_id]
+        else:
+            sr_ids = by_network.get(condition.network_id, [])
+        for sr_id in sr_ids:
+            by_subreddit.setdefault(sr_id, []).append(condition)
+
+    for sr_id, sr_conditions in by_subreddit.iteritems():
+        buckets = dict()
+        for name in QUEUES:
+            queue_conditions = filter_conditions(name, sr_conditions)
+            for subject in ('submission', 'comment'):
+                for condition in queue_conditions:
+                    if condition.subject not in (subject, 'both'):
+                        continue
+                    key = (name, subject, condition.action)
+                    buckets.setdefault(key, []).append(condition)
+        for key, bucket in buckets.iteritems():
+            buckets[key] = ConditionMatcher(bucket)
+        condition_dict[sr_id] = buckets
+
+    # the new buckets haven't been ordered yet, and items haven't been
+    # checked against them
+    order_conditions.versions.clear()
+    item_views.clear()
+
+    logging.info('Loaded %s conditions for %s subreddits',
+                    len(conditions), len(condition_dict))
+    return condition_dict
+
+
+def order_conditions(subreddit, condition_dict):
+    """Returns a subreddit's condition buckets, sorted by cost.
+
+    Each bucket is sorted by expected cost divided by hit rate, from the
+    measured condition statistics. The order is kept until conditions are
+    reloaded or the statistics are saved, rather than sorted for every item.
+    """
+    buckets = condition_dict.get(subreddit.id, dict())
+    if order_conditions.versions.get(subreddit.id) != condition_stats.version:
+        key = lambda c: condition_stats.order_key(c.id, estimated_requests(c))
+        for bucket in buckets.itervalues():
+            bucket.sort(key)
+        order_conditions.versions[subreddit.id] = condition_stats.version
+    return buckets
+# statistics version each subreddit's buckets were last sorted with
+order_conditions.versions = dict()
+
+
+def detach_conditions(conditions):
+    """Expunges conditions and all their sub-conditions from the session."""
+    for condition in conditions:
+        detach_conditions(condition.additional_conditions)
+        if condition in db.session:
+            db.session.expunge(condition)
+
+
+def get_subject(item):
+    """Returns the condition subject that applies to the item."""
+    if isinstance(item, reddit.objects.Submission):
+        return 'submission'
+    elif isinstance(item, reddit.objects.Comment):
+        return 'comment'
+    return None
 
 
 def filter_conditions(name, conditions):
@@ -231,36 +644,67 @@ def filter_conditions(name, conditions):
                 c.num_reports == None and c.is_shadowbanned != True]
 
 
-def check_conditions(subreddit, item, conditions):
+def check_conditions(subreddit, item, conditions, view=None):
     """Checks an item against a set of conditions.
 
+    The conditions must be a ConditionMatcher already filtered for the item's
+    subject, holding the conditions in the order they should be checked.
+    If view is set, it's the item's ItemView, so attributes already extracted
+    for other sets of conditions aren't extracted again, and conditions the
+    item was already checked against (in another queue) are skipped.
+
     Returns the first condition that matches, or a list of all conditions that
     match if check_all_conditions is set on the subreddit. Returns None if no
     conditions match.
     """
-    if isinstance(item, reddit.objects.Submission):
-        conditions = [c for c in conditions
-                          if c.subject == 'submission' or
-                             c.subject == 'both']
-        logging.debug('      Checking submission titled "%s"',
-                        item.title.encode('ascii', 'ignore'))
-    elif isinstance(item, reddit.objects.Comment):
-        conditions = [c for c in conditions
-                          if c.subject == 'comment' or
-                             c.subject == 'both']
-        logging.debug('      Checking comment by user %s',
-                        item.author.name)
-
-    # sort the conditions so the easiest ones are checked first
-    conditions.sort(key=condition_complexity)
+    if view is None:
+        view = ItemView(item)
+
+    if logging.root.isEnabledFor(logging.DEBUG):
+        if isinstance(item, reddit.objects.Submission):
+            logging.debug('      Checking submission titled "%s"',
+                            item.title.encode('ascii', 'ignore'))
+        elif isinstance(item, reddit.objects.Comment):
+            logging.debug('      Checking comment by user %s',
+                            item.author.name)
+
     matched = list()
+    # ids of matching conditions for each attribute, found in a single pass
+    attribute_matches = dict()
 
     for condition in conditions:
+        if condition.id in conditions.invalid or condition.id in view.checked:
+            continue
+
+        start_time = time()
+        requests = scheduler.requests
+
+        # expensive attributes are left for check_condition to extract once
+        # the rest of the condition has passed
+        if condition.attribute in EXPENSIVE_ATTRIBUTES:
+            regex_match = None
+        else:
+            if condition.attribute not in attribute_matches:
+                test_string = view.get(condition.attribute)
+                if test_string is None:
+                    attribute_matches[condition.attribute] = None
+                else:
+                    attribute_matches[condition.attribute] = \
+                        conditions.match(condition.attribute, test_string)
+            if attribute_matches[condition.attribute] is None:
+                continue
+            regex_match = (condition.id in
+                           attribute_matches[condition.attribute])
+
         try:
-            match = check_condition(item, condition)
+            match = check_condition(item, condition, regex_match, view)
         except:
             match = False
 
+        condition_stats.record(condition.id, time() - start_time,
+                               scheduler.requests - requests, match)
+        view.checked.add(condition.id)
+
         if match:
             if subreddit.check_all_conditions:
                 matched.append(condition)
@@ -274,100 +718,235 @@ def check_conditions(subreddit, item, conditions):
     return None
 
 
-def check_condition(item, condition):
+def check_condition(item, condition, regex_match=None, view=None):
     """Checks an item against a single condition (and sub-conditions).
-    
+
+    If regex_match is set, it is used as the (non-inverted) result of the
+    condition's regex instead of matching it again. If view is set, it's the
+    item's ItemView, used to get the attribute to match against.
+
+    The cheap parts of the condition and all its sub-conditions are checked
+    first, and only if they all pass are the parts that need requests (user
+    info, ranks and expensive attributes like meme_name) checked.
+
     Returns True if it matches, or False if not
     """
-    start_time = time()
+    # only build debug messages if they'll actually be logged
+    debug = logging.root.isEnabledFor(logging.DEBUG)
+    if debug:
+        start_time = time()
+    if view is None:
+        view = ItemView(item)
+
+    satisfied = (check_condition_filters(item, condition, regex_match, view,
+                                         debug) and
+                 check_condition_lookups(item, condition, regex_match, view,
+                                         debug))
+
+    if debug:
+        logging.debug('        Result = %s in %s',
+                        satisfied, elapsed_since(start_time))
+    return satisfied
 
-    if condition.attribute == 'user':
-        if item.author:
-            test_string = item.author.name
-    elif (condition.attribute == 'body' and
+
+def check_condition_filters(item, condition, regex_match, view, debug):
+    """Checks the parts of a condition that don't need any requests."""
+    if condition.attribute not in EXPENSIVE_ATTRIBUTES:
+        if not check_condition_regex(condition, regex_match, view, debug):
+            return False
+
+    # check number of reports
+    if condition.num_reports is not None:
+        if condition.auto_reapproving != False:
+            # get number of reports already cleared
+            entry = get_auto_reapproval(item)
+            if entry is not None:
+                previous_reports = entry.total_reports
+            else:
+                previous_reports = 0
+            total_reports = item.num_reports + previous_reports
+        else:
+            total_reports = item.num_reports
+
+        if total_reports < condition.num_reports:
+            return False
+    elif item.num_reports != 0:
+        return False
+
+    # make sure all sub-conditions pass as well
+    for sub_condition in condition.additional_conditions:
+        if not check_condition_filters(item, sub_condition, None, view,
+                                       debug):
+            return False
+    return True
+
+
+def check_condition_lookups(item, condition, regex_match, view, debug):
+    """Checks the parts of a condition that may need requests."""
+    if condition.attribute in EXPENSIVE_ATTRIBUTES:
+        if not check_condition_regex(condition, regex_match, view, debug):
+            return False
+
+    satisfied = check_user_conditions(item, condition)
+    if debug:
+        logging.debug('          User condition result = %s', satisfied)
+    if not satisfied:
+        return False
+
+    # make sure all sub-conditions pass as well
+    for sub_condition in condition.additional_conditions:
+        if not check_condition_lookups(item, sub_condition, None, view,
+                                       debug):
+            return False
+    return True
+
+
+def check_condition_regex(condition, regex_match, view, debug):
+    """Returns whether an item passes a condition's regex.
+
+    If regex_match is None, the regex is matched against the item's
+    attribute from view. The result is flipped for inverse conditions.
+    """
+    if regex_match is None:
+        test_string = view.get(condition.attribute)
+        if test_string is None:
+            return False
+
+        if debug:
+            logging.debug('        Check #%s: "%s" %smatch ^%s$',
+                            condition.id,
+                            test_string.encode('ascii', 'ignore'),
+                            'NOT ' if condition.inverse else '',
+                            condition.value.encode('ascii', 'ignore').lower())
+
+        regex = get_condition_regex(condition)
+        if regex is None:
+            # invalid regex, already reported when it was compiled
+            return False
+        regex_match = bool(regex.search(test_string))
+    elif debug:
+        logging.debug('        Check #%s: regex match = %s',
+                        condition.id, regex_match)
+
+    # flip the result it's an inverse condition
+    if condition.inverse:
+        return not regex_match
+    return regex_match
+
+
+def compile_conditions(conditions):
+    """Compiles the regexes for conditions and all their sub-conditions.
+
+    Returns the number of conditions with invalid regexes.
+    """
+    invalid = 0
+    for condition in conditions:
+        if get_condition_regex(condition) is None:
+            invalid += 1
+        invalid += compile_conditions(condition.additional_conditions)
+    return invalid
+
+
+class ItemView(object):
+
+    """Lazily extracts the attributes of an item that conditions check.
+
+    Each attribute is only extracted the first time a condition asks for
+    it, then remembered for the rest of the item's checks, so expensive ones
+    (like meme_name, which may load a page) are never fetched twice and are
+    never fetched at all if nothing checks them.
+
+    Also keeps the ids of the conditions the item has been checked against,
+    and whether it was removed, so an item that's in several queues isn't
+    checked against the same condition twice (see get_item_view).
+
+    """
+
+    def __init__(self, item):
+        self.item = item
+        self.strings = dict()
+        self.checked = set()
+        self.removed = False
+
+    def get(self, attribute):
+        """Returns the test string for attribute, see get_test_string().
+
+        Returns None if the item has nothing to check or the attribute
+        couldn't be extracted.
+        """
+        try:
+            return self.strings[attribute]
+        except KeyError:
+            pass
+        try:
+            test_string = get_test_string(self.item, attribute)
+        except:
+            test_string = None
+        self.strings[attribute] = test_string
+        return test_string
+
+
+def get_item_view(item):
+    """Returns the ItemView for an item, shared by every queue it's in.
+
+    Views are kept by fullname for one pass over the queues (see
+    new_pass), so a submission that's in the modqueue, /new and the reports
+    in the same run is only checked once against each condition. A condition
+    is only in the buckets of queues it applies to (report conditions, which
+    need reports, are never in another queue's buckets), so skipping
+    conditions already checked never skips one the item could now match.
+    Views aren't kept between passes, since an item's reports can change
+    and the report queue is checked again every pass.
+    """
+    try:
+        view = item_views.get(item.content_id)
+    except KeyError:
+        view = ItemView(item)
+        item_views.set(item.content_id, view)
+    else:
+        # use the latest copy of the item from the listing
+        view.item = item
+    return view
+
+
+def new_pass():
+    """Forgets the items checked by the previous pass over the queues."""
+    item_views.clear()
+
+
+def get_test_string(item, attribute):
+    """Returns the string to check a condition on attribute against.
+
+    Returns None if the item has nothing to check, e.g. when checking the
+    author of an item whose author has deleted their account.
+    """
+    if attribute == 'user':
+        if not item.author:
+            return None
+        test_string = item.author.name
+    elif (attribute == 'body' and
             isinstance(item, reddit.objects.Submission)):
         test_string = item.selftext
-    elif condition.attribute.startswith('media_'):
+    elif attribute.startswith('media_'):
         if item.media:
             try:
-                if condition.attribute == 'media_user':
+                if attribute == 'media_user':
                     test_string = item.media['oembed']['author_name']
-                elif condition.attribute == 'media_title':
+                elif attribute == 'media_title':
                     test_string = item.media['oembed']['description']
-                elif condition.attribute == 'media_description':
+                elif attribute == 'media_description':
                     test_string = item.media['oembed']['description']
             except KeyError:
                 test_string = ''
         else:
             test_string = ''
-    elif condition.attribute == 'meme_name':
+    elif attribute == 'meme_name':
         test_string = get_meme_name(item)
     else:
-        test_string = getattr(item, condition.attribute)
+        test_string = getattr(item, attribute)
     if not test_string:
         test_string = ''
-
-    if condition.inverse:
-        logging.debug('        Check #%s: "%s" NOT match ^%s$',
-                        condition.id,
-                        test_string.encode('ascii', 'ignore'),
-                        condition.value.encode('ascii', 'ignore').lower())
-    else:
-        logging.debug('        Check #%s: "%s" match ^%s$',
-                        condition.id,
-                        test_string.encode('ascii', 'ignore'),
-                        condition.value.encode('ascii', 'ignore').lower())
-
-    if re.search('^'+condition.value+'$',
-            test_string.lower(),
-            re.DOTALL|re.UNICODE|re.IGNORECASE):
-        satisfied = True
-    else:
-        satisfied = False
-
-    # flip the result it's an inverse condition
-    if condition.inverse:
-        satisfied = not satisfied
-
-    # check number of reports if necessary
-    if satisfied and condition.num_reports is not None:
-        if condition.auto_reapproving != False:
-            # get number of reports already cleared
-            try:
-                entry = (AutoReapproval.query.filter(
-                         AutoReapproval.permalink == get_permalink(item))
-                        .one())
-                previous_reports = entry.total_reports
-            except NoResultFound:
-                previous_reports = 0
-            total_reports = item.num_reports + previous_reports
-        else:
-            total_reports = item.num_reports
-
-        satisfied = (total_reports >= condition.num_reports)
-    elif satisfied and condition.num_reports is None:
-        satisfied = (item.num_reports == 0)
-
-    # check user conditions if necessary
-    if satisfied:
-        satisfied = check_user_conditions(item, condition)
-        logging.debug('          User condition result = %s', satisfied)
-
-    # make sure all sub-conditions are satisfied as well
-    if satisfied:
-        if condition.additional_conditions:
-            logging.debug('        Checking sub-conditions:')
-        for sub_condition in condition.additional_conditions:
-            match = check_condition(item, sub_condition)
-            if not match:
-                satisfied = False
-                break
-        if condition.additional_conditions:
-            logging.debug('        Sub-condition result = %s', satisfied)
-
-    logging.debug('        Result = %s in %s',
-                    satisfied, elapsed_since(start_time))
-    return satisfied
+    return test_string
 
 
 def check_user_conditions(item, condition):
@@ -402,36 +981,38 @@ def check_user_conditions(item, condition):
 
     # shadowbanned check
     if condition.is_shadowbanned is not None:
-        user = item.reddit_session.get_redditor(item.author, fetch=False)
-        try: # try to get user overview
-            list(user.get_overview(limit=1))
-        except: # if that failed, they're probably shadowbanned
+        if user_is_shadowbanned(item):
             return fail_result
 
     # get user info
-    user = item.reddit_session.get_redditor(item.author)
+    if (condition.is_gold is not None or
+            condition.link_karma is not None or
+            condition.comment_karma is not None or
+            condition.combined_karma is not None or
+            condition.account_age is not None):
+        user = get_user_info(item)
 
     # reddit gold check
     if condition.is_gold is not None:
-        if condition.is_gold != user.is_gold:
+        if condition.is_gold != user['is_gold']:
             return fail_result
 
     # karma checks
     if condition.link_karma is not None:
-        if user.link_karma < condition.link_karma:
+        if user['link_karma'] < condition.link_karma:
             return fail_result
     if condition.comment_karma is not None:
-        if user.comment_karma < condition.comment_karma:
+        if user['comment_karma'] < condition.comment_karma:
             return fail_result
     if condition.combined_karma is not None:
-        if (user.link_karma + user.comment_karma) \
+        if (user['link_karma'] + user['comment_karma']) \
                 < condition.combined_karma:
             return fail_result
 
     # account age check
     if condition.account_age is not None:
         if (datetime.utcnow() \
-                - datetime.utcfromtimestamp(user.created_utc)).days \
+                - datetime.utcfromtimestamp(user['created_utc'])).days \
                 < condition.account_age:
             return fail_result
 
@@ -439,31 +1020,140 @@ def check_user_conditions(item, condition):
     return not fail_result
 
 
+def get_user_info(item):
+    """Returns a dict of gold/karma/age info for the item's author.
+
+    Results are cached by username for user_ttl seconds.
+    """
+    username = item.author.name.lower()
+    try:
+        return user_cache.get(username)
+    except KeyError:
+        pass
+
+    user = scheduler.call_once(('redditor', username), PRIORITY_LOOKUP,
+                               item.reddit_session.get_redditor, item.author)
+    info = {'is_gold': user.is_gold,
+            'link_karma': user.link_karma,
+            'comment_karma': user.comment_karma,
+            'created_utc': user.created_utc}
+    user_cache.set(username, info)
+    return info
+
+
+def user_is_shadowbanned(item):
+    """Returns True if the item's author appears to be shadowbanned.
+
+    Results are cached by username for shadowban_ttl seconds.
+    """
+    username = item.author.name.lower()
+    try:
+        return shadowban_cache.get(username)
+    except KeyError:
+        pass
+
+    user = item.reddit_session.get_redditor(item.author, fetch=False)
+    try: # try to get user overview
+        scheduler.call_once(('overview', username), PRIORITY_LOOKUP,
+                            lambda: list(user.get_overview(limit=1)))
+        shadowbanned = False
+    except: # if that failed, they're probably shadowbanned
+        shadowbanned = True
+    shadowban_cache.set(username, shadowbanned)
+    return shadowbanned
+
+
 def user_has_rank(subreddit, user, rank):
     """Returns true if user has sufficient rank in the subreddit."""
-    sr_name = subreddit.display_name.lower()
-
-    # fetch mod/contrib lists if necessary
-    if sr_name not in user_has_rank.moderator_cache:
-        mod_list = set()
-        for mod in subreddit.get_moderators():
-            mod_list.add(mod.name)
-        user_has_rank.moderator_cache[sr_name] = mod_list
-
-        contrib_list = set()
-        for contrib in subreddit.get_contributors():
-            contrib_list.add(contrib.name)
-        user_has_rank.contributor_cache[sr_name] = contrib_list
-
-    if user.name in user_has_rank.moderator_cache[sr_name]:
-        if rank == 'moderator' or rank == 'contributor':
-            return True
-    elif user.name in user_has_rank.contributor_cache[sr_name]:
-        if rank == 'contributor':
-            return True
+    # moderators are also considered to be contributors
+    if user.name in get_rank_list(subreddit, 'moderator'):
+        return True
+    if rank == 'contributor':
+        return user.name in get_rank_list(subreddit, 'contributor')
     return False
-user_has_rank.moderator_cache = dict()
-user_has_rank.contributor_cache = dict()
+
+
+def get_rank_list(subreddit, rank):
+    """Returns the set of names with rank ('moderator' or 'contributor').
+
+    Lists are fetched the first time they're needed and cached per subreddit
+    for rank_ttl seconds. After that, the stale list keeps being used while a
+    fresh one is fetched in the background.
+    """
+    key = (subreddit.display_name.lower(), rank)
+    try:
+        names, fresh = rank_cache.peek(key)
+    except KeyError:
+        return fetch_rank_list(subreddit, rank)
+
+    if not fresh:
+        with get_rank_list.lock:
+            if key not in get_rank_list.refreshing:
+                get_rank_list.refreshing.add(key)
+                thread = threading.Thread(target=refresh_rank_list,
+                                          args=(subreddit, rank))
+                thread.daemon = True
+                thread.start()
+    return names
+get_rank_list.refreshing = set()
+get_rank_list.lock = threading.Lock()
+
+
+def refresh_rank_list(subreddit, rank):
+    """Fetches a rank list in the background, logging any errors."""
+    try:
+        fetch_rank_list(subreddit, rank)
+    except Exception as e:
+        # the stale list stays cached and is used until the next refresh
+        logging.error('  ERROR: Unable to refresh %s list for /r/%s: %s',
+                        rank, subreddit.display_name, e)
+
+
+def fetch_rank_list(subreddit, rank):
+    """Fetches a subreddit's moderator or contributor list into the cache."""
+    key = (subreddit.display_name.lower(), rank)
+    try:
+        if rank == 'moderator':
+            users = subreddit.get_moderators
+        else:
+            users = subreddit.get_contributors
+        names = scheduler.call_once(('rank',)+key, PRIORITY_LOOKUP,
+            lambda: set([user.name for user in users()]))
+        rank_cache.set(key, names)
+        return names
+    finally:
+        with get_rank_list.lock:
+            get_rank_list.refreshing.discard(key)
+
+
+def prefetch_auto_reapprovals(items):
+    """Loads the AutoReapproval entries for all items with IN queries.
+
+    Replaces the entries used by get_auto_reapproval, including a None for
+    each item that doesn't have one.
+    """
+    permalinks = [get_permalink(item) for item in items]
+    entries = dict.fromkeys(permalinks)
+    for i in xrange(0, len(permalinks), PREFETCH_CHUNK_SIZE):
+        chunk = permalinks[i:i+PREFETCH_CHUNK_SIZE]
+        for entry in AutoReapproval.query.filter(
+                AutoReapproval.permalink.in_(chunk)):
+            entries[entry.permalink] = entry
+    get_auto_reapproval.entries = entries
+
+
+def get_auto_reapproval(item):
+    """Returns the item's AutoReapproval entry, or None if it has none."""
+    permalink = get_permalink(item)
+    try:
+        return get_auto_reapproval.entries[permalink]
+    except KeyError:
+        pass
+    entry = (AutoReapproval.query.filter(
+             AutoReapproval.permalink == permalink).first())
+    get_auto_reapproval.entries[permalink] = entry
+    return entry
+get_auto_reapproval.entries = dict()
 
 
 def get_permalink(item):
@@ -479,41 +1169,42 @@ def get_permalink(item):
 
 def respond_to_modmail(modmail, start_time):
     """Responds to modmail if any submitters sent one before approval."""
-    cache = list()
     # respond to any modmail sent in the last 5 mins
     time_window = timedelta(minutes=5)
     approvals = ActionLog.query.filter(
                     and_(ActionLog.action == 'approve',
                          ActionLog.action_time >= start_time - time_window)
                     ).all()
+    if not approvals:
+        return
+
+    # index unreplied modmail by (destination, author) in a single pass,
+    # stopping once it's older than every approved item
+    oldest = min([item.created_utc for item in approvals])
+    index = dict()
+    for message in modmail:
+        created = datetime.utcfromtimestamp(message.created_utc)
+        if created < oldest:
+            break
+        if message.replies or not message.author:
+            continue
+        key = (message.dest.lower(), message.author.name)
+        # messages are newest first, so each list is too
+        index.setdefault(key, []).append((created, message))
 
     for item in approvals:
         found = None
-        done = False
-
-        for i in cache:
-            if datetime.utcfromtimestamp(i.created_utc) < item.created_utc:
-                done = True
-                break
-            if (i.dest.lower() == '#'+item.subreddit.name.lower() and
-                    i.author.name == item.user and
-                    not i.replies):
-                found = i
+        messages = index.get(('#'+item.subreddit.name.lower(), item.user), [])
+        for i, (created, message) in enumerate(messages):
+            if created >= item.created_utc:
+                found = message
+                # only reply to each message once
+                del messages[i]
                 break
 
-        if not found and not done:
-            for i in modmail:
-                cache.append(i)
-                if datetime.utcfromtimestamp(i.created_utc) < item.created_utc:
-                    break
-                if (i.dest.lower() == '#'+item.subreddit.name.lower() and
-                        i.author.name == item.user and
-                        not i.replies):
-                    found = i
-                    break
-
         if found:
-            found.reply('Your submission has been approved automatically by '+
+            scheduler.call(PRIORITY_NOTIFY, found.reply,
+                'Your submission has been approved automatically by '+
                 cfg_file.get('reddit', 'username')+'. For future submissions '
                 'please wait at least 5 minutes before messaging the mods, '
                 'this post would have been approved automatically even '
@@ -524,8 +1215,15 @@ def publish_modlog(modlog):
 
 
 def get_meme_name(item):
-    """Gets the item's meme name, if relevant/possible."""
+    """Gets the item's meme name, if relevant/possible.
+
+    Results are cached by page url. If a page can't be loaded, or has no
+    meme name in it, the failure is only cached for meme_failure_ttl
+    seconds. If it can't be loaded, no other pages on the same host are
+    requested during that time either.
+    """
     # determine the URL of the page that will contain the meme name
+    url = None
     if item.domain in ['quickmeme.com', 'qkme.me']:
         url = item.url
     elif item.domain.endswith('.qkme.me'):
@@ -539,27 +1237,54 @@ def get_meme_name(item):
                 break
     elif item.domain == 'troll.me':
         url = item.url
-    else:
+    if not url:
         return None
 
-    # load the page and extract the meme name
     try:
-        page = urllib2.urlopen(url)
+        return meme_cache.get(url)
+    except KeyError:
+        pass
+
+    host = urlparse(url).netloc.lower()
+    try:
+        meme_host_failures.get(host)
+        return None
+    except KeyError:
+        pass
+
+    # load the page
+    try:
+        page = urllib2.urlopen(url, timeout=MEME_FETCH_TIMEOUT)
         soup = BeautifulSoup(page)
+    except Exception as e:
+        logging.warning('  Unable to load meme page %s: %s', url, e)
+        meme_cache.set(url, None, meme_host_failures.ttl)
+        meme_host_failures.set(host, True)
+        return None
 
+    # extract the meme name
+    meme_name = None
+    try:
         if (item.domain in ['quickmeme.com', 'qkme.me'] or
                 item.domain.endswith('.qkme.me')):
-            return soup.findAll(id='meme_name')[0].text
+            meme_name = soup.findAll(id='meme_name')[0].text
         elif item.domain.endswith('memegenerator.net'):
             result = soup.findAll(attrs={'class': 'rank'})[0]
             matches = re.search('#\\d+ (.+)$', result.text)
-            return matches.group(1)
+            meme_name = matches.group(1)
         elif item.domain == 'troll.me':
             matches = re.search('^.+?\| (.+?) \|.+?$', soup.title.text)
-            return matches.group(1)
+            meme_name = matches.group(1)
     except:
         pass
-    return None
+
+    # a page without a meme name may be an error page, so try it again soon
+    if meme_name is None:
+        logging.warning('  Unable to find meme name in %s', url)
+        meme_cache.set(url, None, meme_host_failures.ttl)
+    else:
+        meme_cache.set(url, meme_name)
+    return meme_name
     
 def get_moderationlog(subreddit):
     """Retrieves a subreddit's moderation log, in lieu of a functional API implementation"""
@@ -588,23 +1313,52 @@ def get_moderationlog(subreddit):
     return None
     
 def check_network_moderators(network, sr_dict):
-    """Makes sure moderators of subreddits in networks are moderators of neywork_subreddit"""        
-    checked_mods = 0
+    """Gives moderators of a network's subreddits rank in network_subreddit.
+
+    If network_mods is set they're made moderators, and if network_contribs
+    is set they're made approved submitters. Mod lists are read through the
+    rank cache and compared as sets, so each list is fetched at most once per
+    rank_ttl and only missing users are added.
+
+    Returns the number of users added.
+    """
+    if not network.network_subreddit:
+        return 0
+    if not network.network_mods and not network.network_contribs:
+        return 0
+
     network_sr = r.get_subreddit(network.network_subreddit)
-    # get modlist for network sub    
-    network_mods = network_sr.get_moderators()
+    network_name = network.network_subreddit.lower()
 
+    sub_mods = set()
     for subreddit in sr_dict.itervalues():
-        # iterate over modlist, only check mods not already mods of network sub
-        for mod in r.get_subreddit(subreddit.name).get_moderators():
-            if mod not in network_mods:
-                network_sr.make_moderator(mod.name)
-                checked_mods += 1
-            
-    return checked_mods
-
-check_network_moderators.checked_mods = set()
+        if subreddit.name.lower() == network_name:
+            continue
+        sub_mods |= get_rank_list(r.get_subreddit(subreddit.name),
+                                  'moderator')
+
+    added = 0
+    for flag, rank, add_user in [
+            (network.network_mods, 'moderator', network_sr.make_moderator),
+            (network.network_contribs, 'contributor',
+                network_sr.make_contributor)]:
+        if not flag:
+            continue
+        have_rank = get_rank_list(network_sr, rank)
+        for name in sorted(sub_mods - have_rank):
+            try:
+                scheduler.call(PRIORITY_NOTIFY, add_user, name)
+            except Exception as e:
+                logging.error('  ERROR: Unable to make %s a %s of /r/%s: %s',
+                                name, rank, network.network_subreddit, e)
+                continue
+            # keep the cached list current so they aren't added again
+            have_rank.add(name)
+            added += 1
+            logging.info('  Made %s a %s of /r/%s',
+                            name, rank, network.network_subreddit)
 
+    return added
 
 
 def elapsed_since(start_time):
@@ -613,90 +1367,231 @@ def elapsed_since(start_time):
     return timedelta(seconds=round(elapsed))
 
 
-def condition_complexity(condition):
-    """Returns a value representing how difficult a condition is to check."""
-    complexity = 0
+def estimated_requests(condition):
+    """Returns the number of requests a condition is expected to need.
 
-    # approving or removing requires a request
-    if condition.action in ('approve', 'remove'):
-        complexity += 1
+    Used as the cost of conditions that haven't been measured yet.
+    """
+    requests = 0
 
     # meme_name requires an external site page load
     if condition.attribute == 'meme_name':
-        complexity += 1
+        requests += 1
 
     # checking user requires a page load
     if (condition.is_gold is not None or
-            condition.is_shadowbanned is not None or
             condition.link_karma is not None or
             condition.comment_karma is not None or
             condition.combined_karma is not None or
             condition.account_age is not None):
-        complexity += 1
+        requests += 1
 
-    # checking shadowbanned requires an extra page load
+    # checking shadowbanned requires its own page load
     if condition.is_shadowbanned is not None:
-        complexity += 1
+        requests += 1
 
-    if condition.comment is not None:
-        # commenting+distinguishing requires 2 requests
-        if condition.comment_method == 'comment':
-            complexity += 2
-        else:
-            complexity += 1
+    # checking rank requires loading the moderator/contributor list
+    if condition.account_rank is not None:
+        requests += 1
 
-    # add complexities of all sub-conditions too
+    # add requests of all sub-conditions too
     for sub in condition.additional_conditions:
-        complexity += condition_complexity(sub)
+        requests += estimated_requests(sub)
 
-    return complexity
+    return requests
 
 
-def do_subreddits(mod_subreddit, sr_dict, start_utc):
-    """Checks conditions and performs actions for subreddits in sr_dict"""
-    
-    
-    # check reports
-    items = mod_subreddit.get_reports(limit=1000)
-    stop_time = datetime.utcnow() - REPORT_BACKLOG_LIMIT
-    check_items('report', items, sr_dict, stop_time)
-
-    # check spam
-    items = mod_subreddit.get_modqueue(limit=1000)
-    stop_time = (db.session.query(func.max(Subreddit.last_spam))
-                 .filter(Subreddit.enabled == True).one()[0])
-    check_items('spam', items, sr_dict, stop_time)
-    
-    # check new submissions
-    items = mod_subreddit.get_new_by_date(limit=1000)
-    stop_time = (db.session.query(func.max(Subreddit.last_submission))
-                 .filter(Subreddit.enabled == True).one()[0])
-    check_items('submission', items, sr_dict, stop_time)
-
-    # check new comments
-#     comment_multi = '+'.join([s.name for s in subreddits
-    comment_multi = '+'.join([s.name for s in sr_dict.itervalues()
-                              if not s.reported_comments_only])
-    if comment_multi:
+def queue_subreddits(name, sr_dict):
+    """Returns the subreddits in sr_dict whose items are in a queue."""
+    if name == 'comment':
+        return [s for s in sr_dict.itervalues()
+                if not s.reported_comments_only]
+    return sr_dict.values()
+
+
+def get_queue_items(name, mod_subreddit, sr_dict):
+    """Returns the listing for a queue and the time to stop checking at.
+
+    For queues with per-subreddit watermarks, the stop time is the oldest
+    watermark, since all newer items need to be checked for at least one
+    subreddit. Returns (None, None) if there's nothing to fetch.
+    """
+    subreddits = queue_subreddits(name, sr_dict)
+    if not subreddits:
+        return None, None
+
+    if name == 'report':
+        items = scheduler.listing(mod_subreddit.get_reports(limit=1000))
+    elif name == 'spam':
+        items = scheduler.listing(mod_subreddit.get_modqueue(limit=1000))
+    elif name == 'submission':
+        items = scheduler.listing(mod_subreddit.get_new_by_date(limit=1000))
+    elif name == 'comment':
+        comment_multi = '+'.join([s.name for s in subreddits])
         comment_multi_sr = r.get_subreddit(comment_multi)
-        items = comment_multi_sr.get_comments(limit=1000)
-        stop_time = (db.session.query(func.max(Subreddit.last_comment))
-                     .filter(Subreddit.enabled == True).one()[0])
-        check_items('comment', items, sr_dict, stop_time)
+        items = scheduler.listing(comment_multi_sr.get_comments(limit=1000))
+
+    if name in WATERMARKS:
+        stop_time = min([getattr(s, WATERMARKS[name]) for s in subreddits])
+    else:
+        stop_time = datetime.utcnow() - REPORT_BACKLOG_LIMIT
+    return items, stop_time
+
+
+def fetch_items(items, stop_time):
+    """Loads a listing into a list, stopping at the first item at stop_time.
+
+    The item that reached stop_time is included, so check_items stops at the
+    same place it would have when reading the listing itself.
+    """
+    fetched = list()
+    for item in items:
+        fetched.append(item)
+        if datetime.utcfromtimestamp(item.created_utc) <= stop_time:
+            break
+    return fetched
+
+
+def prefetch_queues(names, mod_subreddit, sr_dict):
+    """Fetches the listings for several queues at the same time.
+
+    Returns a dict keyed by queue name of (items, stop_time) tuples, where
+    items is a list. Queues with nothing to fetch, or whose fetch failed,
+    get an empty list.
+    """
+    start_time = time()
+    # the comment stream fetches its own shards
+    if COMMENT_STREAM:
+        names = [name for name in names if name != 'comment']
+
+    # stop times come from the database, so get them before starting threads
+    queues = dict()
+    for name in names:
+        queues[name] = get_queue_items(name, mod_subreddit, sr_dict)
+
+    pool = ThreadPool(len(names))
+    results = dict()
+    try:
+        for name, (items, stop_time) in queues.iteritems():
+            if items is not None:
+                items = metrics.timed('queue.%s.fetch' % name, items)
+                results[name] = pool.apply_async(fetch_items,
+                                                 (items, stop_time))
+        pool.close()
+
+        listings = dict()
+        for name, (items, stop_time) in queues.iteritems():
+            listings[name] = (list(), stop_time)
+            if name not in results:
+                continue
+            try:
+                listings[name] = (results[name].get(), stop_time)
+            except Exception as e:
+                logging.error('  ERROR: Unable to fetch %ss: %s', name, e)
+    finally:
+        pool.terminate()
+
+    logging.info('Fetched %s in %s', ', '.join(
+                    ['%s %ss' % (len(items), name)
+                     for name, (items, stop_time) in listings.iteritems()]),
+                 elapsed_since(start_time))
+    return listings
+
+
+def check_queue(name, mod_subreddit, sr_dict, condition_dict, listing=None):
+    """Checks a single queue for subreddits in sr_dict.
+
+    If listing is set, it's an (items, stop_time) tuple that has already been
+    fetched, otherwise the queue is fetched while it is checked.
+    """
+    if name == 'comment' and COMMENT_STREAM:
+        check_comment_stream(sr_dict, condition_dict)
+        return
+
+    if listing is None:
+        listing = get_queue_items(name, mod_subreddit, sr_dict)
+    items, stop_time = listing
+    if items is not None:
+        check_items(name, items, sr_dict, condition_dict, stop_time)
+
+
+def check_comment_stream(sr_dict, condition_dict):
+    """Checks comments for each comment shard that's due to be polled."""
+    subreddits = dict((s.name.lower(), s)
+                      for s in queue_subreddits('comment', sr_dict))
+    comment_stream.get_shards(subreddits.keys())
+
+    for shard in comment_stream.due_shards():
+        shard_dict = dict((name, subreddits[name]) for name in shard.names)
+        stop_time = min([s.last_comment for s in shard_dict.itervalues()])
+        try:
+            multi = r.get_subreddit(shard.multi)
+            items = fetch_items(metrics.timed('queue.comment.fetch',
+                scheduler.listing(multi.get_comments(
+                    limit=1000, place_holder=shard.cursor))), stop_time)
+        except Exception as e:
+            logging.error('  ERROR: Unable to fetch comments for %s: %s',
+                            shard.multi, e)
+            shard.next_poll = time() + comment_stream.min_interval
+            continue
+
+        unseen = comment_stream.receive(shard, items)
+        if check_items('comment', unseen, shard_dict, condition_dict,
+                       stop_time):
+            comment_stream.commit(shard, items)
+
+
+def do_subreddits(mod_subreddit, sr_dict, condition_dict, start_utc):
+    """Checks conditions and performs actions for subreddits in sr_dict"""
+    new_pass()
+
+    # fetch all the listings at once, but still check them in order
+    listings = dict()
+    if PREFETCH_QUEUES:
+        listings = prefetch_queues(QUEUES, mod_subreddit, sr_dict)
+
+    for name in QUEUES:
+        check_queue(name, mod_subreddit, sr_dict, condition_dict,
+                    listings.get(name))
+
+    # send the comments and messages queued while checking
+    deliver_outbox()
 
     # respond to modmail
     try:
-        respond_to_modmail(r.user.get_modmail(), start_utc)
+        respond_to_modmail(scheduler.listing(r.user.get_modmail()), start_utc)
     except Exception as e:
         logging.error('  ERROR: %s', e)
 
 
+def do_networks(sr_dict):
+    """Syncs moderators for each enabled network.
 
-def main():
-    logging.config.fileConfig(path_to_cfg)
-    start_utc = datetime.utcnow()
-    start_time = time()
+    Network conditions are checked along with each subreddit's own
+    conditions by do_subreddits, so listings are only fetched once.
+    """
+    mods_checked = 0
 
+    # get network list
+    networks = Network.query.filter(Network.enabled == True).all()
+    
+    # do actions on each network
+    for network in networks:
+        # get subreddits in network
+        network_sr_dict = dict()
+        for name, subreddit in sr_dict.iteritems():
+            if subreddit.network == network.id:
+                network_sr_dict[name] = subreddit
+        
+        # check network mods
+        logging.info('Checking network moderators')
+        mods_checked += check_network_moderators(network, network_sr_dict)
+    
+    logging.info('  Checked %s networks, added %s moderators/contributors', len(networks), mods_checked)
+
+
+def login():
+    """Creates the global reddit session and logs in."""
     global r
     try:
         r = reddit.Reddit(user_agent=cfg_file.get('reddit', 'user_agent'))
@@ -706,6 +1601,138 @@ def main():
     except Exception as e:
         logging.error('  ERROR: %s', e)
 
+
+def load_subreddits(shards=None):
+    """Returns a dict of all enabled subreddits, keyed by lowercase name.
+
+    If shards is set, only subreddits in those shards (see get_shard) are
+    included.
+    """
+    subreddits = Subreddit.query.filter(Subreddit.enabled == True).all()
+    sr_dict = dict()
+    for subreddit in subreddits:
+        if (shards is not None and
+                get_shard(subreddit.name, WORKER_SHARDS) not in shards):
+            continue
+        sr_dict[subreddit.name.lower()] = subreddit
+    return sr_dict
+
+
+def get_mod_subreddit(sr_dict):
+    """Returns the subreddit to fetch the moderation queues for sr_dict from.
+
+    Normally that's /r/mod, but a worker uses a multireddit of only its own
+    subreddits if the name isn't too long.
+    """
+    multi = '+'.join(sorted(sr_dict))
+    if not multi or len(multi) > MAX_MULTI_LENGTH:
+        return r.get_subreddit('mod')
+    return r.get_subreddit(multi)
+
+
+def get_settings_fingerprint():
+    """Returns a value that changes whenever conditions or settings change.
+
+    Subreddits' last_* times are left out, since they change every run.
+    """
+    conditions = db.session.query(*Condition.__table__.columns).all()
+    subreddits = db.session.query(Subreddit.id,
+                                  Subreddit.name,
+                                  Subreddit.network,
+                                  Subreddit.enabled,
+                                  Subreddit.auto_reapprove,
+                                  Subreddit.check_all_conditions,
+                                  Subreddit.reported_comments_only).all()
+    networks = db.session.query(Network.id, Network.enabled).all()
+    return hash((tuple(sorted(conditions)),
+                 tuple(sorted(subreddits)),
+                 tuple(sorted(networks))))
+
+
+def get_cache_paths():
+    """Returns (cache, path) pairs for all caches kept between runs."""
+    return [(user_cache,
+             cfg_path('cache', 'user_cache_file', 'user_cache.json')),
+            (shadowban_cache,
+             cfg_path('cache', 'shadowban_cache_file', 'shadowban_cache.json')),
+            (meme_cache,
+             cfg_path('cache', 'meme_cache_file', 'meme_cache.json')),
+            (condition_stats,
+             cfg_path('cache', 'condition_stats_file',
+                      'condition_stats.json')),
+            (comment_stream,
+             cfg_path('cache', 'comment_traffic_file',
+                      'comment_traffic.json'))]
+
+
+def get_cache_stats():
+    """Returns the hits and misses of each cache, by name."""
+    return dict((name, {'hits': cache.hits,
+                        'misses': cache.misses,
+                        'size': len(cache)})
+                for name, cache in (('user', user_cache),
+                                    ('shadowban', shadowban_cache),
+                                    ('rank', rank_cache),
+                                    ('meme', meme_cache)))
+
+
+def get_condition_stats():
+    """Returns the measured statistics of each condition, by id."""
+    with condition_stats.lock:
+        return dict((condition_id, {'evaluations': evaluations,
+                                    'matches': hits,
+                                    'seconds': seconds,
+                                    'requests': requests})
+                    for condition_id, (evaluations, hits, seconds, requests)
+                    in condition_stats.entries.iteritems())
+
+
+def start_metrics():
+    """Starts measuring database queries and the other metrics sources."""
+    metrics.watch_engine(db.engine)
+    metrics.add_gauges('api_requests', 'endpoint',
+                       lambda: dict(scheduler.endpoints))
+    metrics.add_gauges('caches', 'cache', get_cache_stats)
+    metrics.add_gauges('conditions', 'condition', get_condition_stats)
+    metrics.add_gauges('outbox', 'result',
+                       lambda: {'delivered': outbox.delivered,
+                                'failed': outbox.failed})
+
+
+def save_metrics():
+    """Writes the current metrics to metrics_file."""
+    metrics.save(cfg_path('metrics', 'metrics_file', 'metrics.json'))
+
+
+def load_caches():
+    """Loads all persistent caches from disk."""
+    for cache, path in get_cache_paths():
+        cache.load(path)
+
+
+def save_caches():
+    """Saves all persistent caches to disk and logs their hit rates."""
+    for cache, path in get_cache_paths():
+        cache.save(path)
+    logging.info('  User cache: %s hits, %s misses; '
+                 'shadowban cache: %s hits, %s misses',
+                 user_cache.hits, user_cache.misses,
+                 shadowban_cache.hits, shadowban_cache.misses)
+    logging.info('  Meme cache: %s hits, %s misses',
+                 meme_cache.hits, meme_cache.misses)
+
+
+def main():
+    logging.config.fileConfig(path_to_cfg)
+    start_utc = datetime.utcnow()
+    start_time = time()
+
+    start_metrics()
+    # log any actions left uncommitted by a previous run
+    write_buffer.replay()
+    load_caches()
+    login()
+
     mod_subreddit = r.get_subreddit('mod')
 
 
@@ -714,45 +1741,185 @@ def main():
     #
     
     # get subreddit list
-    subreddits = Subreddit.query.filter(Subreddit.enabled == True).all()
-    sr_dict = dict()
-    for subreddit in subreddits:
-        sr_dict[subreddit.name.lower()] = subreddit
+    sr_dict = load_subreddits()
+
+    # load all conditions once for the whole run
+    condition_dict = load_conditions(sr_dict)
     
     # do actions on subreddits
-    do_subreddits(mod_subreddit, sr_dict, start_utc)
+    do_subreddits(mod_subreddit, sr_dict, condition_dict, start_utc)
     
 
     #
     # Do actions on networks
     #
-    mods_checked = 0
+    do_networks(sr_dict)
 
-    # get network list
-    networks = Network.query.filter(Network.enabled == True).all()
-    
-    # do actions on each network
-    for network in networks:
-        # get subreddits in network
-        network_subs = Subreddit.query.filter(Subreddit.network == network.id, Subreddit.enabled == True).all()
-        network_sr_dict = dict()
-        for subreddit in network_subs:
-            network_sr_dict[subreddit.name.lower()] = subreddit
-        
-        # do subreddit actions on subreddits
-        do_subreddits(mod_subreddit, network_sr_dict, start_utc)
-        
-        # check network mods
-        logging.info('Checking network moderators')
-        for subreddit in network_sr_dict.itervalues():
-            # only check subs in networks
-            if subreddit.network:
-                mods_checked += check_network_moderators(network, network_sr_dict)
-    
-    logging.info('  Checked %s networks, added %s moderators', len(networks), mods_checked)
+    save_caches()
+    logging.info('  Sent %s API requests, coalesced %s duplicates',
+                 scheduler.requests, scheduler.coalesced)
+    if outbox.failed:
+        logging.info('  Gave up on %s comments/messages', outbox.failed)
 
+    metrics.add_time('run', time() - start_time)
+    save_metrics()
     logging.info('Completed full run in %s', elapsed_since(start_time))
 
 
+def daemon(worker=None):
+    """Runs the bot continuously instead of once per invocation.
+
+    The reddit session, conditions and caches stay loaded between cycles,
+    and each queue is polled on its own interval from the [daemon] section
+    of the config. Conditions are reloaded whenever they're edited.
+    Stops after the current cycle on SIGINT or SIGTERM.
+
+    If worker is set, it's the worker's home shard, and only subreddits in
+    the shards it holds (see ShardLocks) are checked. Shards are claimed
+    whenever subreddits would be reloaded.
+    """
+    logging.config.fileConfig(path_to_cfg)
+
+    shard_locks = None
+    shards = None
+    if worker is not None:
+        logging.info('Starting worker for shard %s of %s',
+                        worker, WORKER_SHARDS)
+        shard_locks = ShardLocks(db.engine, WORKER_SHARDS, worker,
+                                 WORKER_TAKEOVER_DELAY)
+        # keep each worker's files apart
+        cfg_path.prefix = 'worker%s_' % worker
+        write_buffer.path = cfg_path('database', 'journal_file',
+                                     'action_journal.log')
+        outbox.path = cfg_path('reddit', 'outbox_file', 'outbox.db')
+
+    start_metrics()
+    # log any actions left uncommitted by a previous run
+    write_buffer.replay()
+    load_caches()
+    login()
+    mod_subreddit = r.get_subreddit('mod')
+
+    intervals = dict()
+    for name, default in DAEMON_INTERVALS.iteritems():
+        intervals[name] = int(cfg_get('daemon', name+'_interval', default))
+    next_run = dict.fromkeys(intervals, 0)
+    last_run_utc = dict.fromkeys(intervals, datetime.utcnow())
+
+    def stop(signum, frame):
+        logging.info('Received signal %s, stopping after this cycle', signum)
+        daemon.running = False
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    daemon.running = True
+
+    fingerprint = None
+    sr_dict = condition_dict = None
+
+    while daemon.running:
+        # reload subreddits and conditions if they (or our shards) changed
+        if time() >= next_run['reload']:
+            try:
+                new_fingerprint = get_settings_fingerprint()
+                if shard_locks is not None:
+                    new_shards = shard_locks.update()
+                    if new_shards != shards:
+                        logging.info('Holding shards %s', ', '.join(
+                                        [str(shard) for shard in
+                                         sorted(new_shards)]) or 'none')
+                        shards = new_shards
+                        fingerprint = None
+                if new_fingerprint != fingerprint:
+                    logging.info('Loading subreddits and conditions')
+                    new_sr_dict = load_subreddits(shards)
+                    condition_dict = load_conditions(new_sr_dict)
+                    sr_dict = new_sr_dict
+                    if shard_locks is not None:
+                        mod_subreddit = get_mod_subreddit(sr_dict)
+                    fingerprint = new_fingerprint
+            except Exception as e:
+                # keep going with the subreddits and conditions already
+                # loaded, and try again at the next reload
+                logging.error('  ERROR: Unable to reload subreddits and '
+                              'conditions: %s', e)
+                db.session.rollback()
+                if sr_dict is None:
+                    raise
+                # but never act on subreddits in shards given up
+                if shard_locks is not None:
+                    sr_dict = dict((name, subreddit) for name, subreddit
+                                   in sr_dict.iteritems()
+                                   if get_shard(name, WORKER_SHARDS) in shards)
+                    mod_subreddit = get_mod_subreddit(sr_dict)
+            next_run['reload'] = time() + intervals['reload']
+
+        # queues that are due at the same time share their item views
+        new_pass()
+
+        # fetch the listings for all queues that are due at the same time
+        listings = dict()
+        due_queues = [name for name in QUEUES if time() >= next_run[name]]
+        if PREFETCH_QUEUES and len(due_queues) > 1:
+            listings = prefetch_queues(due_queues, mod_subreddit, sr_dict)
+
+        for name in DAEMON_TASKS:
+            if not daemon.running or time() < next_run[name]:
+                continue
+            if (name in GLOBAL_TASKS and shard_locks is not None and
+                    0 not in shards):
+                next_run[name] = time() + intervals[name]
+                continue
+
+            cycle_utc = datetime.utcnow()
+            cycle_start = time()
+            try:
+                if name in QUEUES:
+                    check_queue(name, mod_subreddit, sr_dict, condition_dict,
+                                listings.get(name))
+                elif name == 'outbox':
+                    deliver_outbox()
+                elif name == 'modmail':
+                    respond_to_modmail(scheduler.listing(r.user.get_modmail()),
+                                       last_run_utc[name])
+                elif name == 'network':
+                    # networks can span shards
+                    if shard_locks is not None:
+                        do_networks(load_subreddits())
+                    else:
+                        do_networks(sr_dict)
+                write_buffer.flush()
+            except Exception as e:
+                logging.error('  ERROR: %s', e)
+                write_buffer.recover()
+            logging.info('  %s cycle took %.2fs', name, time() - cycle_start)
+            metrics.add_time('daemon.'+name, time() - cycle_start)
+
+            last_run_utc[name] = cycle_utc
+            next_run[name] = time() + intervals[name]
+            if name == 'comment' and COMMENT_STREAM:
+                next_run[name] = comment_stream.next_poll()
+
+        if time() >= next_run['cache']:
+            save_caches()
+            save_metrics()
+            next_run['cache'] = time() + intervals['cache']
+
+        # sleep in short steps so signals are handled promptly
+        while daemon.running and time() < min(next_run.itervalues()):
+            sleep(1)
+
+    deliver_outbox()
+    save_caches()
+    save_metrics()
+    if shard_locks is not None:
+        shard_locks.release()
+    logging.info('Daemon stopped')
+
+
 if __name__ == '__main__':
-    main()
+    if '--worker' in sys.argv[1:]:
+        daemon(int(sys.argv[sys.argv.index('--worker') + 1]))
+    elif '--daemon' in sys.argv[1:]:
+        daemon()
+    else:
+        main()
@@ -0,0 +1,164 @@
+import os
+import json
+import logging
+from datetime import datetime
+
+from sqlalchemy import DateTime
+from sqlalchemy.sql import and_
+
+from models import db, ActionLog, AutoReapproval
+
+# format used to store datetimes in the journal
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class WriteBuffer(object):
+
+    """Batches ActionLog and AutoReapproval writes into fewer commits.
+
+    Rows are added to the session straight away, but are only committed when
+    flush() is called or max_rows are waiting. Before a row is added, it is
+    appended to a journal file. If the bot dies (or a commit fails) before
+    the rows are committed, replay() writes them from the journal, so an
+    action that was already performed on reddit is never left unlogged.
+
+    Journal entries are replayed by key (see REPLAY_KEYS), so replaying rows
+    that did make it into the database doesn't duplicate them, and rows
+    taken back by discard() are deleted again. If a replay
+    fails too, the journal is replayed by every flush() until one succeeds,
+    so it's never cleared while it holds uncommitted rows.
+
+    """
+
+    # columns identifying a row when replaying, by table name
+    REPLAY_KEYS = {'action_log': ('permalink', 'action', 'action_time'),
+                   'auto_reapprovals': ('permalink',)}
+    MODELS = {'action_log': ActionLog,
+              'auto_reapprovals': AutoReapproval}
+
+    def __init__(self, path, max_rows):
+        self.path = path
+        self.max_rows = max_rows
+        self.pending = 0
+        # True while the journal holds rows from a failed commit
+        self.dirty = False
+
+    def add(self, row):
+        """Journals row and adds it to the session to be committed later."""
+        self.journal(row)
+        db.session.add(row)
+        self.pending += 1
+        if self.pending >= self.max_rows:
+            self.flush()
+
+    def discard(self, row):
+        """Takes back a row added by add(), whether or not it's committed.
+
+        Used when the action a row logs couldn't be performed after all.
+        """
+        self.journal(row, discard=True)
+        if row in db.session.new:
+            db.session.expunge(row)
+        else:
+            db.session.delete(row)
+        self.pending += 1
+
+    def journal(self, row, discard=False):
+        """Appends row's values to the journal."""
+        entry = {'table': row.__tablename__, 'values': dict()}
+        if discard:
+            entry['discard'] = True
+        for column in row.__table__.columns:
+            if column.name == 'id':
+                continue
+            value = getattr(row, column.name)
+            if isinstance(value, datetime):
+                value = value.strftime(DATETIME_FORMAT)
+            entry['values'][column.name] = value
+
+        with open(self.path, 'a') as journal:
+            journal.write(json.dumps(entry)+'\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def flush(self):
+        """Commits the session, then clears the journal.
+
+        If the commit fails, the session is rolled back and the journaled
+        rows are replayed instead. If an earlier replay failed, the journal
+        is replayed after the commit rather than cleared.
+        """
+        try:
+            db.session.commit()
+            if self.dirty:
+                self.replay()
+        except Exception as e:
+            logging.error('  ERROR: Unable to commit %s rows: %s',
+                            self.pending, e)
+            self.recover()
+            return
+        self.clear()
+
+    def recover(self):
+        """Rolls back the session and writes the journaled rows again.
+
+        If that fails too, the journal is kept for the next replay.
+        """
+        db.session.rollback()
+        try:
+            self.replay()
+        except Exception as e:
+            logging.error('  ERROR: Unable to replay journal: %s', e)
+            db.session.rollback()
+            self.dirty = True
+
+    def replay(self):
+        """Writes any rows left in the journal to the database."""
+        if not os.path.exists(self.path):
+            return
+
+        entries = list()
+        with open(self.path) as journal:
+            for line in journal:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # a partly-written last line from a crash mid-write
+                    logging.warning('  Skipping corrupt journal entry: %s',
+                                    line.strip())
+        if not entries:
+            self.clear()
+            return
+
+        for entry in entries:
+            model = self.MODELS[entry['table']]
+            values = entry['values']
+            for column in model.__table__.columns:
+                if (isinstance(column.type, DateTime) and
+                        values.get(column.name)):
+                    values[column.name] = datetime.strptime(
+                        values[column.name], DATETIME_FORMAT)
+
+            keys = self.REPLAY_KEYS[entry['table']]
+            row = model.query.filter(and_(*[getattr(model, key) == values[key]
+                                            for key in keys])).first()
+            if entry.get('discard'):
+                if row is not None:
+                    db.session.delete(row)
+                continue
+            if row is None:
+                row = model()
+            for name, value in values.iteritems():
+                setattr(row, name, value)
+            db.session.add(row)
+
+        db.session.commit()
+        logging.info('  Replayed %s journaled rows', len(entries))
+        self.clear()
+
+    def clear(self):
+        """Empties the journal once its rows are safely committed."""
+        self.pending = 0
+        self.dirty = False
+        if os.path.exists(self.path):
+            open(self.path, 'w').close()
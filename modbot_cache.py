@@ -0,0 +1,139 @@
+import os
+import json
+import logging
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class LRUCache(object):
+
+    """A dict-like cache that holds at most max_size entries.
+
+    When full, the least-recently-used entry is evicted to make room for a
+    new one. Lookups of missing keys raise KeyError, so None can be cached
+    like any other value. All operations are safe to use from multiple
+    threads.
+
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """Returns the cached value for key, marking it as recently used."""
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """Stores value under key, evicting the oldest entry if necessary."""
+        with self.lock:
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+            self.entries[key] = value
+
+    def delete(self, key):
+        """Removes key from the cache if it is present."""
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        """Removes all entries from the cache."""
+        with self.lock:
+            self.entries.clear()
+
+
+class TTLCache(LRUCache):
+
+    """An LRUCache whose entries expire after a number of seconds.
+
+    Each entry can be given its own ttl, otherwise the cache's default ttl is
+    used. Expired entries are treated as missing. The cache can be saved to
+    and loaded from a JSON file so it survives between runs, which means keys
+    and values must be JSON-serializable.
+
+    """
+
+    def __init__(self, max_size, ttl):
+        super(TTLCache, self).__init__(max_size)
+        self.ttl = ttl
+
+    def get(self, key):
+        """Returns the cached value for key if it hasn't expired."""
+        try:
+            value, fresh = self.peek(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        if not fresh:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key):
+        """Returns a (value, fresh) tuple for key, even if it has expired.
+
+        fresh is False if the entry has expired. Raises KeyError if there is
+        no entry at all. This lets callers keep using a stale value while
+        they fetch a new one.
+        """
+        with self.lock:
+            expires, value = self.entries.pop(key)
+            self.entries[key] = (expires, value)
+        return value, expires > time()
+
+    def set(self, key, value, ttl=None):
+        """Stores value under key for ttl seconds (or the default ttl)."""
+        if ttl is None:
+            ttl = self.ttl
+        super(TTLCache, self).set(key, (time() + ttl, value))
+
+    def load(self, path):
+        """Loads unexpired entries from a file written by save()."""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as cache_file:
+                entries = json.load(cache_file)
+        except (IOError, ValueError) as e:
+            logging.warning('  Unable to load cache from %s: %s', path, e)
+            return
+
+        now = time()
+        for key, expires, value in entries:
+            if expires > now:
+                super(TTLCache, self).set(key, (expires, value))
+
+    def save(self, path):
+        """Writes all unexpired entries to a file, oldest first."""
+        now = time()
+        with self.lock:
+            entries = [(key, expires, value)
+                       for key, (expires, value) in self.entries.iteritems()
+                       if expires > now]
+        try:
+            # write to a temp file first so a crash can't truncate the cache
+            with open(path+'.tmp', 'w') as cache_file:
+                json.dump(entries, cache_file)
+            os.rename(path+'.tmp', path)
+        except (IOError, OSError) as e:
+            logging.warning('  Unable to save cache to %s: %s', path, e)
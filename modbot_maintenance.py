@@ -0,0 +1,86 @@
+import logging, logging.config
+from datetime import datetime, timedelta
+from optparse import OptionParser
+from time import time
+
+from sqlalchemy.sql import text
+
+from models import cfg_file, path_to_cfg, db
+
+
+def prune_table(table, time_column, cutoff, batch_size, archive):
+    """Deletes rows older than cutoff from table, a batch at a time.
+
+    Small batches keep each transaction (and its locks) short, so the bot
+    can keep running while old history is removed. If archive is True,
+    rows are copied into <table>_archive before being deleted.
+
+    Returns the number of rows deleted.
+    """
+    if archive:
+        db.session.execute(text(
+            'CREATE TABLE IF NOT EXISTS %s_archive '
+            '(LIKE %s INCLUDING DEFAULTS)' % (table, table)))
+        db.session.commit()
+
+    batch = ('SELECT id FROM %s WHERE %s < :cutoff ORDER BY id LIMIT :limit'
+             % (table, time_column))
+    deleted = 0
+    while True:
+        if archive:
+            db.session.execute(text(
+                'INSERT INTO %s_archive SELECT * FROM %s WHERE id IN (%s)'
+                % (table, table, batch)),
+                {'cutoff': cutoff, 'limit': batch_size})
+        result = db.session.execute(text(
+            'DELETE FROM %s WHERE id IN (%s)' % (table, batch)),
+            {'cutoff': cutoff, 'limit': batch_size})
+        db.session.commit()
+
+        deleted += result.rowcount
+        if result.rowcount < batch_size:
+            break
+    return deleted
+
+
+def main():
+    parser = OptionParser(description='Removes old entries from the '
+                          'action_log and auto_reapprovals tables.')
+    parser.add_option('-d', '--days', type='int',
+                      help='keep this many days of history (default: '
+                           'action_log_retention_days in the config)')
+    parser.add_option('-b', '--batch-size', type='int', default=10000,
+                      help='rows to delete per transaction')
+    parser.add_option('-a', '--archive', action='store_true', default=False,
+                      help='copy rows into *_archive tables before deleting')
+    options, args = parser.parse_args()
+
+    logging.config.fileConfig(path_to_cfg)
+
+    days = options.days
+    if days is None and cfg_file.has_option('database',
+                                            'action_log_retention_days'):
+        days = cfg_file.getint('database', 'action_log_retention_days')
+    if not days or days <= 0:
+        parser.error('a positive number of days to keep is required')
+
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    start_time = time()
+
+    logging.info('Pruning history older than %s', cutoff)
+    deleted = prune_table('action_log', 'action_time', cutoff,
+                          options.batch_size, options.archive)
+    logging.info('  Removed %s action_log rows', deleted)
+    deleted = prune_table('auto_reapprovals', 'last_approval_time', cutoff,
+                          options.batch_size, options.archive)
+    logging.info('  Removed %s auto_reapprovals rows', deleted)
+
+    db.session.execute(text('ANALYZE action_log'))
+    db.session.execute(text('ANALYZE auto_reapprovals'))
+    db.session.commit()
+
+    logging.info('Completed pruning in %.1fs', time() - start_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+import re
+import logging
+
+from modbot_cache import LRUCache
+
+# maximum number of compiled condition regexes to keep in memory
+REGEX_CACHE_SIZE = 5000
+
+# python's re module can't compile a pattern with more groups than this
+MAX_REGEX_GROUPS = 99
+
+REGEX_FLAGS = re.DOTALL|re.UNICODE|re.IGNORECASE
+REGEX_METACHARS = set('.^$*+?{}[]()|\\')
+
+# patterns that can't be safely combined into a larger alternation
+UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?[a-zA-Z]')
+
+
+class ConditionMatcher(object):
+
+    """Matches a list of conditions against an item's attributes.
+
+    Conditions are grouped by the attribute they check. Within each group,
+    values that are a plain literal (or an alternation of literals, like a
+    list of domains or usernames) become hash-set lookups, and the rest are
+    joined into a combined alternation that is used to rule out every regex
+    in the group with a single search. Only when the combined regex matches
+    are the individual regexes tested to find out which ones matched.
+
+    The conditions list keeps the order it was given in (or sorted into with
+    sort()), so callers can check conditions in cost order and stop at the
+    first match.
+
+    """
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+        self.invalid = set()
+        self.literals = dict()
+        self.regexes = dict()
+        self.combined = dict()
+
+        for condition in conditions:
+            regex = get_condition_regex(condition)
+            if regex is None:
+                self.invalid.add(condition.id)
+                continue
+
+            attribute = condition.attribute
+            values = literal_values(condition.value)
+            if values is not None:
+                literals = self.literals.setdefault(attribute, dict())
+                for value in values:
+                    literals.setdefault(value, set()).add(condition.id)
+            else:
+                self.regexes.setdefault(attribute, []).append(
+                    (condition.id, condition.value, regex))
+
+        for attribute, regexes in self.regexes.iteritems():
+            self.combined[attribute] = combine_regexes(regexes)
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def __iter__(self):
+        return iter(self.conditions)
+
+    def sort(self, key):
+        """Sorts the conditions in place, matching is unaffected."""
+        self.conditions.sort(key=key)
+
+    def match(self, attribute, test_string):
+        """Returns the ids of conditions whose regex matches test_string.
+
+        Only conditions checking the given attribute are considered, and the
+        result ignores each condition's inverse setting.
+        """
+        matched = set()
+
+        literals = self.literals.get(attribute)
+        if literals:
+            key = test_string.lower()
+            matched.update(literals.get(key, ()))
+            # $ also matches before a trailing newline
+            if key.endswith('\n'):
+                matched.update(literals.get(key[:-1], ()))
+
+        for combined, regexes in self.combined.get(attribute, ()):
+            if combined is not None and not combined.search(test_string):
+                continue
+            for condition_id, value, regex in regexes:
+                if regex.search(test_string):
+                    matched.add(condition_id)
+
+        return matched
+
+
+def get_condition_regex(condition):
+    """Returns the compiled regex for a condition's value.
+
+    Compiled regexes are cached by condition id along with the value they
+    were compiled from, so editing a condition replaces its cached regex.
+    Returns None if the value is not a valid regex.
+    """
+    try:
+        value, regex = get_condition_regex.cache.get(condition.id)
+        if value == condition.value:
+            return regex
+    except KeyError:
+        pass
+
+    try:
+        regex = re.compile('^'+condition.value+'$', REGEX_FLAGS)
+    except re.error as e:
+        logging.error('  ERROR: Condition #%s has an invalid regex: %s',
+                        condition.id, e)
+        regex = None
+
+    get_condition_regex.cache.set(condition.id, (condition.value, regex))
+    return regex
+get_condition_regex.cache = LRUCache(REGEX_CACHE_SIZE)
+
+
+def literal_values(value):
+    """Returns the set of strings a value can match, if it is literal.
+
+    Handles plain strings and alternations of plain strings, optionally
+    wrapped in a single group, e.g. "(youtube\\.com|youtu\\.be)". Returns
+    the lowercased strings, or None if the value uses any other regex syntax.
+    """
+    # an alternation is only a whole-string match when it's in a group,
+    # since "^a|b$" means "starts with a, or ends with b"
+    grouped = False
+    if value.startswith('(?:') and value.endswith(')'):
+        value = value[3:-1]
+        grouped = True
+    elif value.startswith('(') and value.endswith(')'):
+        value = value[1:-1]
+        grouped = True
+
+    values = set()
+    current = []
+    chars = iter(value)
+    for char in chars:
+        if char == '\\':
+            escaped = next(chars, None)
+            # escapes like \d or \w are character classes, not literals
+            if escaped is None or escaped.isalnum() or escaped == '_':
+                return None
+            current.append(escaped)
+        elif char == '|' and grouped:
+            values.add(''.join(current).lower())
+            current = []
+        elif char in REGEX_METACHARS:
+            return None
+        else:
+            current.append(char)
+    values.add(''.join(current).lower())
+
+    return values
+
+
+def combine_regexes(regexes):
+    """Splits regexes into chunks that can each be searched as one pattern.
+
+    Returns a list of (combined regex, regexes) tuples. The combined regex is
+    None when a chunk holds a single regex (or ones that can't be combined),
+    in which case its regexes have to be searched individually.
+    """
+    chunks = list()
+    separate = list()
+    current = list()
+    groups = 0
+
+    for entry in regexes:
+        condition_id, value, regex = entry
+        if UNCOMBINABLE.search(value) or regex.groups > MAX_REGEX_GROUPS:
+            separate.append(entry)
+            continue
+        if current and groups + regex.groups > MAX_REGEX_GROUPS:
+            chunks.append(current)
+            current = list()
+            groups = 0
+        current.append(entry)
+        groups += regex.groups
+    if current:
+        chunks.append(current)
+
+    combined = list()
+    for chunk in chunks:
+        if len(chunk) == 1:
+            combined.append((None, chunk))
+            continue
+        pattern = '|'.join(['(?:^'+value+'$)'
+                            for condition_id, value, regex in chunk])
+        try:
+            combined.append((re.compile(pattern, REGEX_FLAGS), chunk))
+        except (re.error, AssertionError, OverflowError):
+            combined.append((None, chunk))
+    if separate:
+        combined.append((None, separate))
+
+    return combined
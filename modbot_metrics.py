@@ -0,0 +1,165 @@
+import os
+import json
+import logging
+import threading
+from time import time
+
+from sqlalchemy import event
+
+
+class Metrics(object):
+
+    """Counters and timers describing what the bot spends its time on.
+
+    Timers hold a count and a total number of seconds, counters a single
+    number, both keyed by a dotted name like "queue.report.fetch". Values
+    from other objects (cache hit rates, API requests by endpoint) are added
+    as gauges, functions that return a dict of current values when a
+    snapshot is taken.
+
+    Everything is cumulative from when the bot started, so rates can be
+    worked out from two snapshots, the same as Prometheus does.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = dict()
+        self.counters = dict()
+        self.gauges = dict()
+        self.started = time()
+
+    def add_time(self, name, seconds, count=1):
+        """Adds seconds (spent over count operations) to a timer."""
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += count
+            timer[1] += seconds
+
+    def seconds(self, prefix):
+        """Returns the total seconds of all timers starting with prefix."""
+        with self.lock:
+            return sum(seconds for name, (count, seconds)
+                       in self.timers.iteritems() if name.startswith(prefix))
+
+    def increment(self, name, amount=1):
+        """Adds amount to a counter."""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def add_gauges(self, name, label, func):
+        """Adds func() to every snapshot, under name.
+
+        func must return a dict, whose keys are exported to Prometheus with
+        the given label.
+        """
+        self.gauges[name] = (label, func)
+
+    def timed(self, name, items):
+        """Yields from an iterable, timing how long each item took to get.
+
+        Used for listings that are fetched lazily while they're checked.
+        """
+        items = iter(items)
+        while True:
+            start_time = time()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.add_time(name, time() - start_time, 0)
+                return
+            self.add_time(name, time() - start_time)
+            yield item
+
+    def watch_engine(self, engine):
+        """Counts and times every query sent through a SQLAlchemy engine."""
+        local = threading.local()
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_query(*args):
+            local.start_time = time()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_query(*args):
+            self.add_time('db.query', time() - local.start_time)
+
+    def snapshot(self):
+        """Returns all metrics as a dict that can be written as JSON."""
+        with self.lock:
+            snapshot = {'started': self.started,
+                        'updated': time(),
+                        'timers': dict((name, {'count': count,
+                                               'seconds': seconds})
+                                       for name, (count, seconds)
+                                       in self.timers.iteritems()),
+                        'counters': dict(self.counters),
+                        'labels': dict()}
+        for name, (label, func) in self.gauges.iteritems():
+            snapshot[name] = func()
+            snapshot['labels'][name] = label
+        return snapshot
+
+    def save(self, path):
+        """Writes a snapshot to a JSON file."""
+        try:
+            with open(path+'.tmp', 'w') as metrics_file:
+                json.dump(self.snapshot(), metrics_file, indent=1,
+                          sort_keys=True)
+            os.rename(path+'.tmp', path)
+        except (IOError, OSError) as e:
+            logging.warning('  Unable to save metrics to %s: %s', path, e)
+
+
+def prometheus_text(snapshots, prefix='automoderator'):
+    """Returns snapshots in Prometheus' text exposition format.
+
+    snapshots maps a worker name to that worker's snapshot, use an empty
+    name for a bot that isn't running as workers. Each worker's metrics are
+    labelled with its name.
+
+    Timers become <name>_count and <name>_seconds_total counters, and each
+    gauge group becomes a metric labelled by the keys of its dict. Groups of
+    dicts (like per-condition statistics) become a metric for each field.
+    """
+    # Prometheus needs all of a metric's samples together, so samples are
+    # grouped by metric name across the workers
+    samples = dict()
+
+    def metric_name(*parts):
+        return '_'.join((prefix,)+parts).replace('.', '_').replace('-', '_')
+
+    def add(name, labels, value):
+        if labels:
+            sample = '%s{%s} %s' % (name, ','.join(
+                '%s="%s"' % (label, str(label_value).replace('"', '\\"'))
+                for label, label_value in labels), value)
+        else:
+            sample = '%s %s' % (name, value)
+        samples.setdefault(name, []).append(sample)
+
+    for worker, snapshot in sorted(snapshots.iteritems()):
+        worker_labels = [('worker', worker)] if worker else []
+
+        for name, timer in snapshot['timers'].iteritems():
+            add(metric_name(name)+'_count', worker_labels, timer['count'])
+            add(metric_name(name)+'_seconds_total', worker_labels,
+                timer['seconds'])
+        for name, value in snapshot['counters'].iteritems():
+            add(metric_name(name)+'_total', worker_labels, value)
+
+        for group, label in snapshot['labels'].iteritems():
+            for key, value in snapshot[group].iteritems():
+                labels = worker_labels+[(label, key)]
+                if isinstance(value, dict):
+                    for field, field_value in value.iteritems():
+                        add(metric_name(group, field), labels, field_value)
+                else:
+                    add(metric_name(group), labels, value)
+
+        add(metric_name('updated_timestamp_seconds'), worker_labels,
+            snapshot['updated'])
+
+    lines = list()
+    for name in sorted(samples):
+        lines.extend(sorted(samples[name]))
+    return '\n'.join(lines)+'\n'
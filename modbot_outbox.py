@@ -0,0 +1,153 @@
+import logging
+import sqlite3
+from multiprocessing.pool import ThreadPool
+from time import time
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    target TEXT NOT NULL,
+    subject TEXT,
+    body TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL
+)'''
+
+
+class Outbox(object):
+
+    """Durable queue of comments and messages waiting to be delivered.
+
+    Deciding what to post is separated from posting it: perform_action() only
+    puts deliveries into the outbox, and drain() sends everything that's due
+    using a pool of workers, so checking items never waits on them. Entries
+    are kept in a SQLite file until they're delivered, so deliveries that
+    fail (or are left over when the bot dies) are retried on a later drain
+    without the item needing to be found in a listing again.
+
+    Each retry waits twice as long as the last, starting at retry_delay
+    seconds, and entries are dropped after max_attempts failures.
+
+    """
+
+    def __init__(self, path, workers, max_attempts, retry_delay):
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.connection = None
+        # objects already loaded for targets, by fullname, so they don't
+        # need to be fetched again when delivering
+        self.things = dict()
+        self.delivered = 0
+        self.failed = 0
+
+    def connect(self):
+        """Returns the connection to the outbox file, opening it if needed."""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path)
+            self.connection.execute(SCHEMA)
+            self.connection.commit()
+        return self.connection
+
+    def put(self, kind, target, body, subject=None, thing=None):
+        """Queues a delivery of body to target.
+
+        If thing is given, it's the already-loaded object for target and is
+        used instead of fetching it again.
+        """
+        if thing is not None:
+            self.things[target] = thing
+        now = time()
+        connection = self.connect()
+        connection.execute('INSERT INTO outbox (kind, target, subject, body, '
+                           'next_attempt, created) VALUES (?, ?, ?, ?, ?, ?)',
+                           (kind, target, subject, body, now, now))
+        connection.commit()
+
+    def pending(self):
+        """Returns the number of deliveries waiting in the outbox."""
+        return self.connect().execute(
+            'SELECT count(*) FROM outbox').fetchone()[0]
+
+    def drain(self, deliver):
+        """Delivers all entries that are due, in parallel.
+
+        deliver(kind, target, subject, body, thing) is called for each entry,
+        with thing set to the loaded object for target or None. It can return
+        a list of (kind, target, body, subject, thing) follow-up deliveries,
+        which are queued once it succeeds, and delivered in the same drain
+        while their thing is still loaded.
+        """
+        connection = self.connect()
+        while True:
+            entries = connection.execute(
+                'SELECT id, kind, target, subject, body, attempts FROM outbox '
+                'WHERE next_attempt <= ? ORDER BY id', (time(),)).fetchall()
+            if not entries:
+                break
+            follow_ups = self.deliver_entries(deliver, entries)
+            for follow_up in follow_ups:
+                self.put(*follow_up)
+            if not follow_ups:
+                break
+
+        # forget loaded objects that nothing is waiting on any more
+        waiting = set(row[0] for row in connection.execute(
+            'SELECT DISTINCT target FROM outbox'))
+        for target in self.things.keys():
+            if target not in waiting:
+                del self.things[target]
+
+    def deliver_entries(self, deliver, entries):
+        """Delivers entries in parallel and records the results.
+
+        Returns the follow-up deliveries of the entries that succeeded.
+        """
+        connection = self.connect()
+
+        def attempt(entry):
+            entry_id, kind, target, subject, body, attempts = entry
+            try:
+                return deliver(kind, target, subject, body,
+                               self.things.get(target)), None
+            except Exception as e:
+                return None, e
+
+        # only the workers talk to reddit, the outbox file is only touched
+        # from this thread
+        pool = ThreadPool(min(self.workers, len(entries)))
+        try:
+            results = pool.map(attempt, entries)
+        finally:
+            pool.close()
+            pool.join()
+
+        follow_ups = list()
+        for entry, (result, error) in zip(entries, results):
+            entry_id, kind, target, subject, body, attempts = entry
+            attempts += 1
+            if error is None:
+                connection.execute('DELETE FROM outbox WHERE id = ?',
+                                   (entry_id,))
+                follow_ups.extend(result or [])
+                self.delivered += 1
+            elif attempts >= self.max_attempts:
+                logging.error('  ERROR: Giving up on %s to %s after %s '
+                              'attempts: %s', kind, target, attempts, error)
+                connection.execute('DELETE FROM outbox WHERE id = ?',
+                                   (entry_id,))
+                self.failed += 1
+            else:
+                logging.warning('  Unable to deliver %s to %s, will retry: %s',
+                                kind, target, error)
+                connection.execute(
+                    'UPDATE outbox SET attempts = ?, next_attempt = ? '
+                    'WHERE id = ?',
+                    (attempts,
+                     time() + self.retry_delay * 2 ** (attempts - 1),
+                     entry_id))
+        connection.commit()
+        return follow_ups
@@ -0,0 +1,138 @@
+import heapq
+import itertools
+import threading
+from time import time
+
+# request priorities, lower numbers are sent first
+PRIORITY_ACTION = 0     # removing, approving and flairing items
+PRIORITY_LISTING = 1    # fetching queues and other listings
+PRIORITY_NOTIFY = 2     # comments, messages and mod list changes
+PRIORITY_LOOKUP = 3     # user profiles and mod/contributor lists
+
+# items per page of a reddit listing
+LISTING_PAGE_SIZE = 100
+
+
+class RequestScheduler(object):
+
+    """Spaces out reddit API requests to stay within the rate limit.
+
+    Uses a token bucket holding up to burst tokens that refills at rate
+    tokens per second, and every request takes one token. When requests are
+    waiting for a token, the one with the highest priority (lowest number)
+    goes first, and requests with equal priority go in the order they
+    arrived.
+
+    Requests made with a key are coalesced: if a request with the same key
+    is already in flight, the caller waits for it and gets its result rather
+    than sending a duplicate request.
+
+    The number of requests sent to each endpoint is kept in endpoints. The
+    endpoint is the name of the function called, the first part of the key
+    for coalesced requests, or "listing" for pages of listings.
+
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time()
+        self.condition = threading.Condition()
+        self.waiting = list()
+        self.order = itertools.count()
+        self.inflight = dict()
+        self.inflight_lock = threading.Lock()
+        self.requests = 0
+        self.coalesced = 0
+        self.endpoints = dict()
+
+    def acquire(self, priority, endpoint='other'):
+        """Blocks until a request with the given priority may be sent."""
+        with self.condition:
+            ticket = (priority, next(self.order))
+            heapq.heappush(self.waiting, ticket)
+            while True:
+                self.refill()
+                if self.waiting[0] == ticket and self.tokens >= 1:
+                    break
+                if self.waiting[0] == ticket:
+                    self.condition.wait((1 - self.tokens) / self.rate)
+                else:
+                    self.condition.wait()
+            heapq.heappop(self.waiting)
+            self.tokens -= 1
+            self.requests += 1
+            self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+            # let the next waiter check whether it's their turn
+            self.condition.notify_all()
+
+    def refill(self):
+        """Adds the tokens earned since the last refill."""
+        now = time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def call(self, priority, func, *args, **kwargs):
+        """Waits for a token, then returns func(*args, **kwargs)."""
+        self.acquire(priority, getattr(func, '__name__', 'other'))
+        return func(*args, **kwargs)
+
+    def call_once(self, key, priority, func, *args, **kwargs):
+        """Like call(), but shares the result with callers using the same key.
+
+        Only requests that are in flight at the same time are coalesced, so
+        results still need to be cached elsewhere to be reused later.
+        """
+        with self.inflight_lock:
+            request = self.inflight.get(key)
+            owner = request is None
+            if owner:
+                request = self.inflight[key] = InflightRequest()
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            return request.wait()
+
+        try:
+            self.acquire(priority, str(key[0]))
+            request.result = func(*args, **kwargs)
+        except Exception as e:
+            request.error = e
+            raise
+        finally:
+            with self.inflight_lock:
+                del self.inflight[key]
+            request.done.set()
+        return request.result
+
+    def listing(self, items, priority=PRIORITY_LISTING):
+        """Yields from a listing, taking a token before each page loads."""
+        items = iter(items)
+        for count in itertools.count():
+            if count % LISTING_PAGE_SIZE == 0:
+                self.acquire(priority, 'listing')
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            yield item
+
+
+class InflightRequest(object):
+
+    """A request that other callers with the same key are waiting on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        """Returns the request's result once done, or raises its error."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
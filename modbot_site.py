@@ -1,4 +1,10 @@
-from flask import Flask
+import os
+import json
+from ConfigParser import SafeConfigParser
+
+from flask import Flask, Response, abort, request
+
+from modbot_metrics import prometheus_text
 
 app = Flask(__name__)
 
@@ -9,6 +15,42 @@ def main_page():
     return 'Future home of a web interface.'
 
 
+# the bot's metrics, in Prometheus' text format, including those of any
+# workers (see --worker), labelled by worker
+@app.route('/metrics')
+def metrics_page():
+    if request.remote_addr not in ('127.0.0.1', '::1'):
+        abort(403)
+
+    cfg_dir = os.path.dirname(os.path.abspath(__file__))
+    cfg_file = SafeConfigParser()
+    cfg_file.read(os.path.join(cfg_dir, 'modbot.cfg'))
+    path = 'metrics.json'
+    if cfg_file.has_option('metrics', 'metrics_file'):
+        path = cfg_file.get('metrics', 'metrics_file')
+    shards = 4
+    if cfg_file.has_option('workers', 'shards'):
+        shards = cfg_file.getint('workers', 'shards')
+
+    # workers' files have the same name as the bot's, prefixed with workerN_
+    path = os.path.join(cfg_dir, path)
+    paths = {'': path}
+    for shard in xrange(shards):
+        paths[str(shard)] = os.path.join(os.path.dirname(path), 'worker%s_%s'
+                                         % (shard, os.path.basename(path)))
+
+    snapshots = dict()
+    for worker, worker_path in paths.iteritems():
+        try:
+            with open(worker_path) as metrics_file:
+                snapshots[worker] = json.load(metrics_file)
+        except (IOError, ValueError):
+            pass
+    if not snapshots:
+        abort(404)
+    return Response(prometheus_text(snapshots),
+                    mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
     app.debug = True
     app.run()
@@ -0,0 +1,105 @@
+import os
+import json
+import logging
+import threading
+
+# weight (in evaluations) given to a condition's estimated cost before it
+# has been measured
+PRIOR_WEIGHT = 5
+
+# once a condition has been evaluated this many times, its counts are halved
+# so the statistics follow changes in the subreddit's traffic
+MAX_EVALUATIONS = 10000
+
+
+class ConditionStats(object):
+
+    """Measured cost and hit rate of each condition, used to order them.
+
+    For every evaluation of a condition, the time it took, the number of API
+    requests it made and whether it matched are recorded by condition id.
+    A condition's expected cost is its mean time plus request_cost seconds
+    for each request it makes on average (requests also use up the bot's
+    shared rate limit), and conditions are checked in order of expected cost
+    divided by hit rate, so cheap conditions that often match go first.
+
+    Conditions that haven't been measured yet use an estimated number of
+    requests, which measurements replace as they come in.
+
+    The statistics are kept between runs with save() and load(). version
+    changes whenever they do, so orderings based on them can be cached until
+    it changes.
+
+    """
+
+    def __init__(self, request_cost):
+        self.request_cost = request_cost
+        # [evaluations, hits, seconds, requests] by condition id
+        self.entries = dict()
+        self.lock = threading.RLock()
+        self.version = 0
+
+    def record(self, condition_id, seconds, requests, hit):
+        """Records a single evaluation of a condition."""
+        with self.lock:
+            entry = self.entries.setdefault(condition_id, [0, 0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += int(bool(hit))
+            entry[2] += seconds
+            entry[3] += requests
+            if entry[0] >= MAX_EVALUATIONS:
+                self.entries[condition_id] = [entry[0] / 2, entry[1] / 2,
+                                              entry[2] / 2, entry[3] / 2]
+
+    def expected_cost(self, condition_id, estimated_requests):
+        """Returns the expected seconds to evaluate a condition."""
+        evaluations, hits, seconds, requests = self.entries.get(
+            condition_id, (0, 0, 0.0, 0))
+        cost = seconds + requests * self.request_cost
+        prior = estimated_requests * self.request_cost
+        return (cost + prior * PRIOR_WEIGHT) / (evaluations + PRIOR_WEIGHT)
+
+    def hit_rate(self, condition_id):
+        """Returns the estimated chance of a condition matching."""
+        evaluations, hits = self.entries.get(condition_id, (0, 0))[:2]
+        # add one hit and one miss so unmeasured conditions are neither
+        # certain to match nor certain not to
+        return (hits + 1.0) / (evaluations + 2.0)
+
+    def order_key(self, condition_id, estimated_requests):
+        """Returns a value to sort conditions by, lowest checked first."""
+        return (self.expected_cost(condition_id, estimated_requests) /
+                self.hit_rate(condition_id), condition_id)
+
+    def load(self, path):
+        """Loads statistics from a file written by save()."""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as stats_file:
+                entries = json.load(stats_file)
+        except (IOError, ValueError) as e:
+            logging.warning('  Unable to load statistics from %s: %s', path, e)
+            return
+
+        with self.lock:
+            for condition_id, entry in entries:
+                self.entries[condition_id] = entry
+            self.version += 1
+
+    def save(self, path):
+        """Writes the statistics to a file.
+
+        Saving also updates version, so conditions are re-ordered using the
+        statistics recorded since they were last ordered.
+        """
+        with self.lock:
+            entries = [(condition_id, entry)
+                       for condition_id, entry in self.entries.iteritems()]
+            self.version += 1
+        try:
+            with open(path+'.tmp', 'w') as stats_file:
+                json.dump(entries, stats_file)
+            os.rename(path+'.tmp', path)
+        except (IOError, OSError) as e:
+            logging.warning('  Unable to save statistics to %s: %s', path, e)
@@ -0,0 +1,198 @@
+import os
+import json
+import logging
+from time import time
+
+from modbot_cache import LRUCache
+
+# longest multireddit name ("a+b+c") to put in a single listing url
+MAX_MULTI_LENGTH = 2000
+
+# seconds between re-sharding subreddits by their latest traffic
+RESHARD_INTERVAL = 3600
+
+# weight given to the latest poll when updating a subreddit's traffic
+TRAFFIC_WEIGHT = 0.3
+
+# number of comment fullnames to remember as already checked
+SEEN_SIZE = 100000
+
+
+class CommentShard(object):
+
+    """A group of subreddits whose comments are fetched as one multireddit."""
+
+    def __init__(self, names):
+        self.names = names
+        self.multi = '+'.join(names)
+        # id of the newest comment checked, listings stop when they reach it
+        self.cursor = None
+        self.last_poll = None
+        self.next_poll = 0
+
+
+class CommentStream(object):
+
+    """Polls subreddits' comments in shards sized by their traffic.
+
+    Subreddits are packed into shards so that each shard's combined traffic
+    (in comments per second) fills about poll_items comments every
+    min_interval seconds, and no shard's multireddit name gets too long.
+    Busy subreddits end up alone in their own shard, so they can't crowd
+    quiet ones out of the 1000 comment listing limit.
+
+    Each shard is polled on its own interval, the time it takes to collect
+    about poll_items new comments, between min_interval and max_interval.
+    A shard's listing stops at the newest comment from its last checked
+    poll, and comments already checked from any poll are dropped, so no
+    comment is checked twice.
+
+    Traffic is measured from each poll, and kept between runs with save()
+    and load(). Shards are rebuilt every RESHARD_INTERVAL seconds, or when
+    the subreddits change.
+
+    """
+
+    def __init__(self, poll_items, min_interval, max_interval):
+        self.poll_items = poll_items
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # comments per second, by lowercase subreddit name
+        self.traffic = dict()
+        self.shards = list()
+        self.names = None
+        self.resharded = 0
+        self.seen = LRUCache(SEEN_SIZE)
+
+    def get_shards(self, names):
+        """Returns the shards for a list of subreddit names.
+
+        The shards are rebuilt if the names have changed or it's time to
+        re-shard. Shards with the same subreddits as before keep their
+        cursors and poll times.
+        """
+        names = sorted(name.lower() for name in names)
+        if names == self.names and time() - self.resharded < RESHARD_INTERVAL:
+            return self.shards
+
+        old_shards = dict((shard.multi, shard) for shard in self.shards)
+        self.shards = list()
+        for shard_names in self.pack(names):
+            shard = CommentShard(shard_names)
+            self.shards.append(old_shards.get(shard.multi, shard))
+        self.names = names
+        self.resharded = time()
+        logging.info('  Split %s subreddits into %s comment shards',
+                        len(names), len(self.shards))
+        return self.shards
+
+    def pack(self, names):
+        """Packs names into lists, busiest first, to fit each shard's limits.
+
+        Each name goes into the first shard with room for both its traffic
+        and its length, or a new shard if none has room.
+        """
+        capacity = float(self.poll_items) / self.min_interval
+        shards = list()
+        for name in sorted(names, key=lambda n: -self.traffic.get(n, 0)):
+            rate = self.traffic.get(name, 0)
+            for shard in shards:
+                if (shard['rate'] + rate <= capacity and
+                        shard['length'] + len(name) + 1 <= MAX_MULTI_LENGTH):
+                    break
+            else:
+                shard = {'names': [], 'rate': 0, 'length': -1}
+                shards.append(shard)
+            shard['names'].append(name)
+            shard['rate'] += rate
+            shard['length'] += len(name) + 1
+        return [sorted(shard['names']) for shard in shards]
+
+    def due_shards(self):
+        """Returns the shards that are due to be polled."""
+        now = time()
+        return [shard for shard in self.shards if shard.next_poll <= now]
+
+    def next_poll(self):
+        """Returns the time the next shard is due to be polled."""
+        if not self.shards:
+            return time() + self.max_interval
+        return min(shard.next_poll for shard in self.shards)
+
+    def receive(self, shard, items):
+        """Handles the comments from a poll of shard, newest first.
+
+        Updates its subreddits' traffic and the shard's next poll time, and
+        returns the comments that haven't been seen before. The comments
+        aren't marked as seen until commit() is called once they've been
+        checked, so if checking them fails they're returned again by the
+        next poll.
+        """
+        now = time()
+        counts = dict.fromkeys(shard.names, 0)
+        unseen = list()
+        for item in items:
+            try:
+                self.seen.get(item.content_id)
+            except KeyError:
+                unseen.append(item)
+                name = item.subreddit.display_name.lower()
+                counts[name] = counts.get(name, 0) + 1
+
+        # the first poll has no previous one, so measure traffic over the
+        # time the comments it returned were posted in
+        if shard.last_poll is not None:
+            window = now - shard.last_poll
+        elif len(items) > 1:
+            window = items[0].created_utc - items[-1].created_utc
+        else:
+            window = self.max_interval
+        window = max(window, 1)
+
+        rate = 0
+        for name, count in counts.iteritems():
+            old_rate = self.traffic.get(name)
+            if old_rate is None:
+                self.traffic[name] = float(count) / window
+            else:
+                self.traffic[name] = ((1 - TRAFFIC_WEIGHT) * old_rate +
+                                      TRAFFIC_WEIGHT * count / window)
+            rate += self.traffic[name]
+
+        if rate > 0:
+            interval = self.poll_items / rate
+        else:
+            interval = self.max_interval
+        shard.last_poll = now
+        shard.next_poll = now + min(max(interval, self.min_interval),
+                                    self.max_interval)
+        return unseen
+
+    def commit(self, shard, items):
+        """Marks the comments from a poll of shard as checked.
+
+        The shard's next listing stops at the newest of them.
+        """
+        for item in items:
+            self.seen.set(item.content_id, True)
+        if items:
+            shard.cursor = items[0].id
+
+    def load(self, path):
+        """Loads subreddit traffic from a file written by save()."""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as traffic_file:
+                self.traffic.update(json.load(traffic_file))
+        except (IOError, ValueError) as e:
+            logging.warning('  Unable to load traffic from %s: %s', path, e)
+
+    def save(self, path):
+        """Writes subreddit traffic to a file."""
+        try:
+            with open(path+'.tmp', 'w') as traffic_file:
+                json.dump(self.traffic, traffic_file)
+            os.rename(path+'.tmp', path)
+        except (IOError, OSError) as e:
+            logging.warning('  Unable to save traffic to %s: %s', path, e)
@@ -0,0 +1,150 @@
+import zlib
+import logging
+from time import sleep, time
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import text
+
+# first keys of the two-key advisory locks used by workers, the second key
+# is the shard number
+SHARD_LOCK = 1836016129
+PRESENCE_LOCK = 1836016130
+
+# times to try taking the presence lock in one update
+PRESENCE_ATTEMPTS = 3
+
+
+def get_shard(name, shards):
+    """Returns the shard a subreddit belongs to, out of shards."""
+    return (zlib.crc32(name.lower()) & 0xffffffff) % shards
+
+
+class ShardLocks(object):
+
+    """Claims shards of subreddits for a worker using PostgreSQL locks.
+
+    Subreddits are split into shards by a hash of their name (see
+    get_shard), and a worker only acts on subreddits in shards it holds the
+    advisory lock for, so no two workers ever act on the same subreddit.
+    The locks are held on a connection of their own, so if a worker dies
+    its connection closes and the database releases its locks.
+
+    Each worker has a home shard, which it always claims when it can, and
+    holds a presence lock on it while it's running, and claims no shards
+    until it does. A shard whose presence lock is free has no worker running
+    for it, and once it's been that way for takeover_delay seconds, another
+    worker takes it over (one shard per update, so orphaned shards spread
+    out over the workers). When the home worker comes back, the worker that
+    took over its shard gives it back.
+
+    """
+
+    def __init__(self, engine, shards, home, takeover_delay):
+        self.engine = engine
+        self.shards = shards
+        self.home = home
+        self.takeover_delay = takeover_delay
+        self.connection = None
+        self.present = False
+        self.owned = set()
+        # when each shard was first seen without a running home worker
+        self.orphaned = dict()
+
+    def try_lock(self, namespace, shard):
+        """Returns True if the lock was taken, False if it's held."""
+        return self.connection.execute(
+            text('SELECT pg_try_advisory_lock(:namespace, :shard)')
+                .execution_options(autocommit=True),
+            namespace=namespace, shard=shard).scalar()
+
+    def unlock(self, namespace, shard):
+        """Releases a lock taken by try_lock()."""
+        self.connection.execute(
+            text('SELECT pg_advisory_unlock(:namespace, :shard)')
+                .execution_options(autocommit=True),
+            namespace=namespace, shard=shard)
+
+    def has_worker(self, shard):
+        """Returns True if shard's home worker is running."""
+        if self.try_lock(PRESENCE_LOCK, shard):
+            self.unlock(PRESENCE_LOCK, shard)
+            return False
+        return True
+
+    def update(self):
+        """Claims, takes over and gives back shards as needed.
+
+        Returns the set of shards this worker now holds.
+        """
+        try:
+            if self.connection is None:
+                self.connection = self.engine.connect()
+                self.present = False
+                self.owned = set()
+
+            # another worker's has_worker() holds the presence lock for a
+            # moment, so keep trying until it's held. Until then other
+            # workers can't tell this one is running, so no shards are
+            # claimed.
+            for attempt in xrange(PRESENCE_ATTEMPTS):
+                if self.present:
+                    break
+                if attempt:
+                    sleep(0.1)
+                self.present = self.try_lock(PRESENCE_LOCK, self.home)
+            if not self.present:
+                logging.info('  Waiting for presence lock of shard %s',
+                                self.home)
+                return set(self.owned)
+
+            if self.home not in self.owned:
+                if self.try_lock(SHARD_LOCK, self.home):
+                    self.owned.add(self.home)
+                    logging.info('  Claimed home shard %s', self.home)
+
+            took_over = False
+            now = time()
+            for shard in xrange(self.shards):
+                if shard == self.home:
+                    continue
+
+                if shard in self.owned:
+                    # give the shard back once its own worker is running
+                    if self.has_worker(shard):
+                        self.unlock(SHARD_LOCK, shard)
+                        self.owned.discard(shard)
+                        logging.info('  Gave shard %s back to its worker',
+                                        shard)
+                elif self.has_worker(shard):
+                    self.orphaned.pop(shard, None)
+                else:
+                    orphaned = self.orphaned.setdefault(shard, now)
+                    if (not took_over and
+                            now - orphaned >= self.takeover_delay and
+                            self.try_lock(SHARD_LOCK, shard)):
+                        self.owned.add(shard)
+                        self.orphaned.pop(shard, None)
+                        took_over = True
+                        logging.info('  Took over shard %s', shard)
+        except DBAPIError as e:
+            # the locks went with the connection, start over next time
+            logging.error('  ERROR: Lost shard locks: %s', e)
+            if self.connection is not None:
+                self.connection.invalidate()
+                self.connection = None
+            self.present = False
+            self.owned = set()
+        return set(self.owned)
+
+    def release(self):
+        """Releases all locks when the worker stops."""
+        if self.connection is not None:
+            # the connection goes back to the pool, which would keep the
+            # locks held
+            self.connection.execute(
+                text('SELECT pg_advisory_unlock_all()')
+                    .execution_options(autocommit=True))
+            self.connection.close()
+            self.connection = None
+        self.present = False
+        self.owned = set()
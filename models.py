@@ -196,6 +196,19 @@ class Condition(db.Model):
 class ActionLog(db.Model):
     """Table containing a log of the bot's actions."""
     __tablename__ = 'action_log'
+    __table_args__ = (
+        # alert deduplication and journal replays
+        db.Index('ix_action_log_permalink_action', 'permalink', 'action'),
+        # recent approvals for modmail replies
+        db.Index('ix_action_log_action_action_time', 'action', 'action_time'),
+        # loading recent alerts
+        db.Index('ix_action_log_action_created_utc', 'action', 'created_utc'),
+        # per-subreddit history
+        db.Index('ix_action_log_subreddit_action_time',
+                 'subreddit_id', 'action_time'),
+        # pruning old entries
+        db.Index('ix_action_log_action_time', 'action_time'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     subreddit_id = db.Column(db.Integer,
@@ -225,12 +238,15 @@ class ActionLog(db.Model):
 class AutoReapproval(db.Model):
     """Table keeping track of posts that have been auto-reapproved."""
     __tablename__ = 'auto_reapprovals'
+    __table_args__ = (
+        db.Index('ix_auto_reapprovals_subreddit_id', 'subreddit_id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     subreddit_id = db.Column(db.Integer,
                              db.ForeignKey('subreddits.id'),
                              nullable=False)
-    permalink = db.Column(db.String(255))
+    permalink = db.Column(db.String(255), unique=True)
     original_approver = db.Column(db.String(255))
     total_reports = db.Column(db.Integer, nullable=False, default=0)
     first_approval_time = db.Column(db.DateTime)
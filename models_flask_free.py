@@ -212,6 +212,17 @@ class Condition(Base):
 class ActionLog(Base):
     """Table containing a log of the bot's actions."""
     __tablename__ = 'action_log'
+    __table_args__ = (
+        # alert deduplication and journal replays
+        Index('ix_action_log_permalink_action', 'permalink', 'action'),
+        # recent approvals for modmail replies
+        Index('ix_action_log_action_action_time', 'action', 'action_time'),
+        # loading recent alerts
+        Index('ix_action_log_action_created_utc', 'action', 'created_utc'),
+        # per-subreddit history, and pruning old entries
+        Index('ix_action_log_subreddit_action_time',
+              'subreddit_id', 'action_time'),
+    )
 
     id = Column(Integer, primary_key=True)
     subreddit_id = Column(Integer,
@@ -241,12 +252,15 @@ class ActionLog(Base):
 class AutoReapproval(Base):
     """Table keeping track of posts that have been auto-reapproved."""
     __tablename__ = 'auto_reapprovals'
+    __table_args__ = (
+        Index('ix_auto_reapprovals_subreddit_id', 'subreddit_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     subreddit_id = Column(Integer,
                           ForeignKey('subreddits.id'),
                           nullable=False)
-    permalink = Column(String(255))
+    permalink = Column(String(255), unique=True)
     original_approver = Column(String(255))
     total_reports = Column(Integer, nullable=False, default=0)
     first_approval_time = Column(DateTime)